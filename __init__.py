@@ -1,14 +1,24 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
 from trytond.pool import Pool
-from . import plan
+from . import ir, plan, route, uom, work_center
 
 
 def register():
     Pool.register(
         plan.PlanOperationLine,
         plan.Plan,
+        plan.CostDateContext,
+        plan.OperationsCostCurveContext,
+        plan.OperationsCostCurve,
         plan.CreateRouteStart,
+        route.Route,
+        route.RouteOperation,
+        work_center.WorkCenterCategory,
+        work_center.WorkCenterCategoryRate,
+        work_center.WorkCenter,
+        uom.Uom,
+        ir.Cron,
         module='product_cost_plan_operation', type_='model')
     Pool.register(
         plan.CreateRoute,
@@ -0,0 +1,217 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+'''
+Cost engine of the operation lines.
+
+It works on plans and operations stored in arrays and does not depend on the
+pool nor on a transaction so the formulas can be reused and tested alone.
+'''
+import math
+from array import array
+from decimal import Decimal
+
+_ZERO = Decimal(0)
+
+
+def quantizer(digits):
+    'Return the exponent to quantize a cost to digits decimals'
+    return Decimal(str(10 ** -digits))
+
+
+class Plans(object):
+    'Cost plans stored in arrays indexed by position'
+    __slots__ = ('ids', 'quantities', 'production_quantities', '_positions')
+
+    def __init__(self):
+        self.ids = array('q')
+        self.quantities = array('d')
+        self.production_quantities = array('d')
+        self._positions = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, id, quantity, production_quantity):
+        'Add the plan if it is not yet present and return its position'
+        position = self._positions.get(id)
+        if position is None:
+            position = self._positions[id] = len(self.ids)
+            self.ids.append(id)
+            self.quantities.append(quantity or 0)
+            self.production_quantities.append(production_quantity or 0)
+        return position
+
+    def position(self, id):
+        return self._positions[id]
+
+
+class Operations(object):
+    '''
+    Operation lines stored in arrays indexed by position
+
+    The plan is the position of the line plan in Plans, the time cost is the
+    time in the UoM of the work center rate multiplied by its cost price and
+    the plan UoM quantity is the quantity converted into the plan UoM.
+    '''
+    __slots__ = ('ids', 'plans', 'standard', 'plan_uom_quantities',
+        'time_costs')
+
+    def __init__(self):
+        self.ids = array('q')
+        self.plans = array('l')
+        self.standard = array('b')
+        self.plan_uom_quantities = array('d')
+        # Decimal can not be stored in an array
+        self.time_costs = []
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, id, plan, calculation, plan_uom_quantity, time_cost):
+        'Add an operation line of the plan at position plan'
+        self.ids.append(id)
+        self.plans.append(plan)
+        self.standard.append(calculation == 'standard')
+        self.plan_uom_quantities.append(plan_uom_quantity or 0)
+        self.time_costs.append(time_cost)
+
+
+def _fixed_quantity(plan_quantity, production_quantity):
+    'Return the quantity of the fixed operations of a plan'
+    if not plan_quantity or not production_quantity:
+        return _ZERO
+    return Decimal(str(math.ceil(plan_quantity / production_quantity)))
+
+
+def _line_cost(standard, plan_quantity, plan_uom_quantity, fixed_quantity,
+        time_cost):
+    '''
+    Return the unrounded total cost of one operation line where
+    fixed_quantity is the quantity of the fixed operations of its plan
+    '''
+    if time_cost is None or not plan_quantity:
+        return _ZERO
+    if standard:
+        if not plan_uom_quantity:
+            return _ZERO
+        return Decimal(str(plan_quantity / plan_uom_quantity)) * time_cost
+    return fixed_quantity * time_cost
+
+
+def line_cost(calculation, plan_quantity, production_quantity,
+        plan_uom_quantity, time_cost):
+    'Return the unrounded total cost of one operation line'
+    standard = calculation == 'standard'
+    fixed_quantity = None
+    if not standard:
+        fixed_quantity = _fixed_quantity(plan_quantity, production_quantity)
+    return _line_cost(standard, plan_quantity, plan_uom_quantity,
+        fixed_quantity, time_cost)
+
+
+def total_costs(plans, operations):
+    'Return the unrounded total cost of the operations in their order'
+    quantities = plans.quantities
+    production_quantities = plans.production_quantities
+    # The quantity of fixed operations only depends on the plan
+    fixed_quantities = {}
+
+    costs = []
+    append = costs.append
+    for plan, standard, plan_uom_quantity, time_cost in zip(
+            operations.plans, operations.standard,
+            operations.plan_uom_quantities, operations.time_costs):
+        plan_quantity = quantities[plan]
+        fixed_quantity = None
+        if not standard:
+            fixed_quantity = fixed_quantities.get(plan)
+            if fixed_quantity is None:
+                fixed_quantity = fixed_quantities[plan] = _fixed_quantity(
+                    plan_quantity, production_quantities[plan])
+        append(_line_cost(standard, plan_quantity, plan_uom_quantity,
+                fixed_quantity, time_cost))
+    return costs
+
+
+def line_costs(plans, operations, total_digits, unit_digits):
+    '''
+    Return the total costs and the unit costs of the operations in their
+    order rounded to total_digits and unit_digits
+    '''
+    total_exp = quantizer(total_digits)
+    unit_exp = quantizer(unit_digits)
+    quantities = plans.quantities
+
+    totals, units = [], []
+    for plan, cost in zip(operations.plans, total_costs(plans, operations)):
+        total_cost = cost.quantize(total_exp)
+        totals.append(total_cost)
+        unit_cost = total_cost
+        if unit_cost and quantities[plan]:
+            unit_cost /= Decimal(str(quantities[plan]))
+        units.append(unit_cost.quantize(unit_exp))
+    return totals, units
+
+
+def plan_costs(plans, operations, digits):
+    '''
+    Return the unit operations cost of the plans in their order rounded to
+    digits
+    '''
+    exp = quantizer(digits)
+    totals = [_ZERO] * len(plans)
+    for plan, cost in zip(operations.plans, total_costs(plans, operations)):
+        totals[plan] += cost
+
+    costs = []
+    for total, quantity in zip(totals, plans.quantities):
+        if quantity:
+            costs.append((total / Decimal(str(quantity))).quantize(exp))
+        else:
+            costs.append(Decimal(0))
+    return costs
+
+
+def cost_curves(plans, operations, quantities, digits):
+    '''
+    Return for each plan in their order the list of the unit operations cost
+    at each of the quantities rounded to digits.
+    The time costs of the operations are summed once by plan, the fixed ones
+    together and the standard ones by quantity in plan UoM, so each quantity
+    only costs one multiplication by distinct quantity in plan UoM.
+    '''
+    exp = quantizer(digits)
+    standard = [{} for _ in range(len(plans))]
+    fixed = [_ZERO] * len(plans)
+    for plan, is_standard, plan_uom_quantity, time_cost in zip(
+            operations.plans, operations.standard,
+            operations.plan_uom_quantities, operations.time_costs):
+        if time_cost is None:
+            continue
+        if is_standard:
+            if plan_uom_quantity:
+                standard[plan][plan_uom_quantity] = (
+                    standard[plan].get(plan_uom_quantity, _ZERO)
+                    + time_cost)
+        else:
+            fixed[plan] += time_cost
+
+    quantities = [float(q or 0) for q in quantities]
+    curves = []
+    for plan, production_quantity in enumerate(plans.production_quantities):
+        curve = []
+        for quantity in quantities:
+            if not quantity:
+                curve.append(Decimal(0))
+                continue
+            total = _ZERO
+            for plan_uom_quantity, time_cost in standard[plan].items():
+                total += (Decimal(str(quantity / plan_uom_quantity))
+                    * time_cost)
+            if production_quantity and fixed[plan]:
+                total += (Decimal(str(math.ceil(
+                                quantity / production_quantity)))
+                    * fixed[plan])
+            curve.append((total / Decimal(str(quantity))).quantize(exp))
+        curves.append(curve)
+    return curves
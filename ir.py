@@ -0,0 +1,21 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.pool import PoolMeta
+
+__all__ = ['Cron']
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.method.selection.append(
+            ('product.cost.plan|recompute_all', "Recompute Cost Plans"))
+        cls.method.selection.append(
+            ('product.cost.plan|recompute_drifted',
+                "Recompute Cost Plans Drifted from Route"))
+        cls.method.selection.append(
+            ('production.work_center.category|update_cost_prices',
+                "Update Work Center Category Cost Prices from Rates"))
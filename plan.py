@@ -1,23 +1,69 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+from collections import defaultdict
 from decimal import Decimal
-import math
+import csv
+import datetime
+import logging
+import time
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 from trytond.config import config
-from trytond.model import ModelSQL, ModelView, fields
+from sql import Literal, Null, Select, Union, With
+from sql.aggregate import Count, Max, Sum
+from sql.conditionals import Case, Coalesce, NullIf
+from sql.functions import Ceil, CurrentTimestamp, Round
+from sql.operators import Exists
+
+from trytond.model import Index, ModelSQL, ModelView, fields
 from trytond.pool import Pool, PoolMeta
-from trytond.pyson import Eval, Id
+from trytond.pyson import Bool, Eval, Id, If
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.transaction import Transaction
 from trytond.wizard import Wizard, StateView, StateAction, Button
 from trytond.exceptions import UserWarning, UserError
 from trytond.i18n import gettext
 
+from . import engine
+from .profiling import measure
+from .uom import compute_qty, convert_qty, get_conversion, get_digits
+
 __all__ = ['PlanOperationLine', 'Plan',
     'CreateRouteStart', 'CreateRoute']
 
 
 DIGITS = (16, config.getint('product', 'price_decimal', default=4))
 _ZERO = Decimal(0)
+OPERATIONS_COST_CACHE = config.getboolean(
+    'product_cost_plan_operation', 'operations_cost_cache', default=False)
+REUSE_ROUTE = config.getboolean(
+    'product_cost_plan_operation', 'reuse_route', default=False)
+EXPORT_BATCH = config.getint(
+    'product_cost_plan_operation', 'export_batch_size', default=1000)
+SYNC_ROUTE = config.getboolean(
+    'product_cost_plan_operation', 'sync_route', default=False)
+RECOMPUTE_BATCH = config.getint(
+    'product_cost_plan_operation', 'recompute_batch_size', default=100)
+RECOMPUTE_DELAY = config.getint(
+    'product_cost_plan_operation', 'recompute_delay', default=30)
+# The recompute runs have their own queue to follow their progress
+RECOMPUTE_QUEUE = 'product_cost_plan_recompute'
+CURVE_SIZE = config.getint(
+    'product_cost_plan_operation', 'cost_curve_size', default=10000)
+
+logger = logging.getLogger(__name__)
+
+
+def _sql_format(field, value):
+    'Format the value of a clause on field for SQL'
+    if isinstance(value, (list, tuple)):
+        return [field.sql_format(v) for v in value]
+    return field.sql_format(value)
 
 
 class PlanOperationLine(ModelSQL, ModelView):
@@ -32,6 +78,14 @@ class PlanOperationLine(ModelSQL, ModelView):
         'Operation Type')
     work_center_category = fields.Many2One('production.work_center.category',
         'Work Center Category')
+    work_center = fields.Many2One('production.work_center', 'Work Center',
+        domain=[
+            If(Bool(Eval('work_center_category')),
+                ('category', '=', Eval('work_center_category')),
+                ()),
+            ],
+        help="The work center whose rate prices the operation instead of the "
+        "rate of the category.")
     calculation = fields.Selection([
             ('standard', 'Standard'),
             ('fixed', 'Fixed'),
@@ -72,16 +126,51 @@ class PlanOperationLine(ModelSQL, ModelView):
             digits=DIGITS,
             help="The cost of this operation for each unit of plan's "
             "product."),
-        'get_unit_cost')
+        'get_cost', searcher='search_cost')
     total_cost = fields.Function(fields.Numeric('Total Cost',
             digits=DIGITS,
             help="The cost of this operation for total plan's quantity."),
-        'get_total_cost')
+        'get_cost', searcher='search_cost')
+    rate_time = fields.Float('Time in Rate UOM', readonly=True,
+        help="The time of this operation in the UOM of the rate of the work "
+        "center or of its category.")
+    time_cost = fields.Numeric('Time Cost', readonly=True,
+        help="The cost of the time of this operation at the rate of the work "
+        "center or of its category.")
+    plan_uom_quantity = fields.Float('Quantity in Plan UOM', readonly=True,
+        help="The quantity processed by the time of this operation in the "
+        "plan's UOM.")
+    cost_rates_outdated = fields.Boolean('Cost Rates Outdated',
+        readonly=True,
+        help="The time cost is at a previous rate until it is refreshed.")
 
     @classmethod
     def __setup__(cls):
         super(PlanOperationLine, cls).__setup__()
         cls._order.insert(0, ('sequence', 'ASC'))
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t, (t.work_center_category, Index.Range()),
+                    where=t.work_center_category != Null),
+                Index(t, (t.work_center, Index.Range()),
+                    where=t.work_center != Null),
+                Index(t, (t.plan, Index.Range()),
+                    where=t.cost_rates_outdated == Literal(True)),
+                })
+
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().connection.cursor()
+        table_h = cls.__table_handler__(module_name)
+        table = cls.__table__()
+        time_cost_exist = table_h.column_exist('time_cost')
+        rate_time_exist = table_h.column_exist('rate_time')
+
+        super(PlanOperationLine, cls).__register__(module_name)
+
+        if not time_cost_exist or not rate_time_exist:
+            cursor.execute(*table.select(table.id))
+            cls.update_cost_rates(cls.browse([i for i, in cursor]))
 
     @staticmethod
     def order_sequence(tables):
@@ -98,15 +187,40 @@ class PlanOperationLine(ModelSQL, ModelView):
         ModelData = pool.get('ir.model.data')
         return ModelData.get_id('product', 'uom_hour')
 
-    @fields.depends('work_center_category')
+    @fields.depends('work_center_category', 'work_center')
     def on_change_with_time_uom(self):
+        if self.work_center and self.work_center.uom:
+            return self.work_center.uom.id
         if self.work_center_category:
             return self.work_center_category.uom.id
 
+    @property
+    def cost_rate(self):
+        '''
+        Return the UoM and the cost price pricing the time of the line.
+        The category rate is the one effective at the cost_date of the
+        context if any, the rates at a date being read once for all the
+        lines.
+        '''
+        pool = Pool()
+        Rate = pool.get('production.work_center.category.rate')
+        if self.work_center and self.work_center.cost_price is not None:
+            return self.work_center.uom, self.work_center.cost_price
+        if self.work_center_category:
+            category = self.work_center_category
+            cost_price = category.cost_price
+            date = Transaction().context.get('cost_date')
+            if date:
+                dated_cost_price = Rate.get_cost_price(category.id, date)
+                if dated_cost_price is not None:
+                    cost_price = dated_cost_price
+            return category.uom, cost_price
+        return None, None
+
     @fields.depends('time_uom')
     def on_change_with_time_uom_digits(self, name=None):
         if self.time_uom:
-            return self.time_uom.digits
+            return get_digits(self.time_uom)
         return 2
 
     @staticmethod
@@ -117,55 +231,584 @@ class PlanOperationLine(ModelSQL, ModelView):
     @fields.depends('plan', '_parent_plan.uom')
     def on_change_with_quantity_uom(self):
         if self.plan and self.plan.uom:
-            return self.plan.uom.category.id
+            return self.plan.uom.id
 
     @fields.depends('quantity_uom')
     def on_change_with_quantity_uom_digits(self, name=None):
         if self.quantity_uom:
-            return self.quantity_uom.digits
+            return get_digits(self.quantity_uom)
         return 2
 
     def get_unit_cost(self, name=None):
-        unit_cost = self.total_cost
-        if unit_cost and self.plan and self.plan.quantity:
-            unit_cost /= Decimal(str(self.plan.quantity))
-        digits = self.__class__.unit_cost.digits[1]
-        return unit_cost.quantize(Decimal(str(10 ** -digits)))
+        'Return the unit cost of the line computed by get_cost'
+        return self.get_cost([self], ['unit_cost'])['unit_cost'][self.id]
 
     def get_total_cost(self, name=None, round=True):
-        pool = Pool()
-        Uom = pool.get('product.uom')
-
-        total_cost = _ZERO
-        if not self.work_center_category or not self.time:
-            return total_cost
-
-        if not self.plan or not self.plan.quantity:
-            return Decimal('0')
-        if self.calculation == 'standard' and not self.quantity:
-            return Decimal('0')
-        elif (self.calculation == 'fixed' and
-                not self.plan.production_quantity):
-            return Decimal('0')
-
-        time = Uom.compute_qty(self.time_uom, self.time,
-            self.work_center_category.uom, round=False)
-        if self.calculation == 'standard':
-            quantity = (self.plan.quantity /
-                Uom.compute_qty(self.quantity_uom, self.quantity,
-                    self.plan.uom, round=False))
-        else:
-            quantity = math.ceil(self.plan.quantity
-                / self.plan.production_quantity)
+        rate_uom, cost_price = self.cost_rate
+        if not rate_uom or not self.time or not self.plan:
+            return _ZERO
 
-        total_cost = (Decimal(str(quantity)) * Decimal(str(time))
-            * self.work_center_category.cost_price)
+        time = compute_qty(self.time_uom, self.time, rate_uom)
+        time_cost = Decimal(str(time)) * cost_price
+        plan_uom_quantity = None
+        if self.calculation == 'standard' and self.quantity:
+            plan_uom_quantity = compute_qty(self.quantity_uom, self.quantity,
+                self.plan.uom)
+        total_cost = engine.line_cost(self.calculation, self.plan.quantity,
+            self.plan.production_quantity, plan_uom_quantity, time_cost)
 
         if not round:
             return total_cost
         digits = self.__class__.total_cost.digits[1]
         return total_cost.quantize(Decimal(str(10 ** -digits)))
 
+    @classmethod
+    def get_cost(cls, lines, names):
+        '''
+        Compute unit_cost and total_cost of all lines at once.
+
+        The values are read with one query per slice of ids and the unit of
+        measure conversions are shared between lines.
+        '''
+        with measure('operation_line.get_cost') as stats:
+            return cls._get_cost(lines, names, stats)
+
+    @classmethod
+    def _get_cost(cls, lines, names, stats):
+        values = cls._get_cost_values([l.id for l in lines])
+        stats.rows_read += len(values)
+        plans, operations = cls._get_engine_data(values)
+        total_costs, unit_costs = engine.line_costs(plans, operations,
+            cls.total_cost.digits[1], cls.unit_cost.digits[1])
+        costs = {
+            'total_cost': dict(zip(operations.ids, total_costs)),
+            'unit_cost': dict(zip(operations.ids, unit_costs)),
+            }
+        result = {}
+        for name in names:
+            result[name] = {l.id: costs[name].get(l.id, _ZERO)
+                for l in lines}
+        return result
+
+    @classmethod
+    def _get_total_cost_column(cls, line, plan):
+        '''
+        Return the SQL expression of the unrounded total cost of the line
+        table joined to the plan table.
+        The time cost is at the rates effective at the cost_date of the
+        context if any.
+        '''
+        time_cost = line.time_cost
+        date = Transaction().context.get('cost_date')
+        if date:
+            time_cost = cls._get_dated_time_cost_column(line, date)
+        # Ceil of NULL raises an error on SQLite
+        quantity = Case(
+            (line.calculation == 'fixed',
+                Ceil(Coalesce(
+                        plan.quantity / NullIf(plan.production_quantity, 0),
+                        0))),
+            else_=plan.quantity / NullIf(line.plan_uom_quantity, 0))
+        return cls.total_cost.sql_cast(
+            Coalesce(quantity * time_cost, 0))
+
+    @classmethod
+    def _get_dated_time_cost_column(cls, line, date):
+        '''
+        Return the SQL expression of the time cost of the line table at the
+        rates effective at date.
+        The lines priced by their category having a rate at date use it with
+        the stored time in the rate UoM, the others their stored time cost.
+        '''
+        pool = Pool()
+        Rate = pool.get('production.work_center.category.rate')
+        WorkCenter = pool.get('production.work_center')
+        work_center = WorkCenter.__table__()
+        rate = Rate.get_cost_prices_query(date)
+
+        by_category = ~Exists(work_center.select(work_center.id,
+                where=(work_center.id == line.work_center)
+                & (work_center.cost_price != Null)))
+        rate_price = rate.select(rate.cost_price,
+            where=rate.category == line.work_center_category)
+        return Case(
+            (by_category,
+                Coalesce(cls.time_cost.sql_cast(line.rate_time) * rate_price,
+                    line.time_cost)),
+            else_=line.time_cost)
+
+    @classmethod
+    def _get_cost_column(cls, name, line, plan):
+        '''
+        Return the SQL expression of the cost name rounded like get_cost
+        from the stored rates
+        '''
+        column = Round(cls._get_total_cost_column(line, plan),
+            cls.total_cost.digits[1])
+        if name == 'unit_cost':
+            column = Round(cls.unit_cost.sql_cast(
+                    Coalesce(column / NullIf(plan.quantity, 0), 0)),
+                cls.unit_cost.digits[1])
+        return column
+
+    @classmethod
+    def search_cost(cls, name, clause):
+        pool = Pool()
+        Plan = pool.get('product.cost.plan')
+        line = cls.__table__()
+        plan = Plan.__table__()
+        _, operator, value = clause
+        Operator = fields.SQL_OPERATORS[operator]
+        value = _sql_format(getattr(cls, name), value)
+        column = cls._get_cost_column(name, line, plan)
+        query = line.join(plan, condition=line.plan == plan.id).select(
+            line.id,
+            where=Operator(column, value))
+        return [('id', 'in', query)]
+
+    @classmethod
+    def _order_cost(cls, name, tables):
+        pool = Pool()
+        Plan = pool.get('product.cost.plan')
+        line, _ = tables[None]
+        if 'plan' not in tables:
+            plan = Plan.__table__()
+            tables['plan'] = {
+                None: (plan, plan.id == line.plan),
+                }
+        plan, _ = tables['plan'][None]
+        return [cls._get_cost_column(name, line, plan)]
+
+    @classmethod
+    def order_unit_cost(cls, tables):
+        return cls._order_cost('unit_cost', tables)
+
+    @classmethod
+    def order_total_cost(cls, tables):
+        return cls._order_cost('total_cost', tables)
+
+    @classmethod
+    def _get_export_columns(cls):
+        '''
+        Return the list of the name and type of the columns written by
+        export_costs in the order of the rows
+        '''
+        return [
+            ('id', 'int64'),
+            ('plan', 'string'),
+            ('sequence', 'int64'),
+            ('name', 'string'),
+            ('operation_type', 'string'),
+            ('work_center_category', 'string'),
+            ('work_center', 'string'),
+            ('calculation', 'string'),
+            ('time', 'float64'),
+            ('time_uom', 'string'),
+            ('quantity', 'float64'),
+            ('quantity_uom', 'string'),
+            ('unit_cost', 'decimal'),
+            ('total_cost', 'decimal'),
+            ]
+
+    @classmethod
+    def export_costs(cls, path, format='csv', domain=None,
+            batch_size=EXPORT_BATCH):
+        '''
+        Write the operation lines matching domain with their costs into the
+        file at path as CSV or Parquet.
+        The lines are read and their costs computed by batches of batch_size
+        so the memory used does not depend on the number of lines.
+        Return the number of lines written.
+        '''
+        if format == 'parquet' and not pyarrow:
+            raise UserError(gettext(
+                    'product_cost_plan_operation.export_missing_pyarrow'))
+        elif format not in {'csv', 'parquet'}:
+            raise ValueError("unknown export format %s" % format)
+        domain = domain or []
+
+        columns = cls._get_export_columns()
+        header = [n for n, _ in columns]
+
+        def rows(lines):
+            costs = cls.get_cost(lines, ['unit_cost', 'total_cost'])
+            for line in lines:
+                yield [line.id, line.plan.rec_name, line.sequence, line.name,
+                    line.operation_type.rec_name
+                    if line.operation_type else None,
+                    line.work_center_category.rec_name
+                    if line.work_center_category else None,
+                    line.work_center.rec_name if line.work_center else None,
+                    line.calculation, line.time, line.time_uom.rec_name,
+                    line.quantity,
+                    line.quantity_uom.rec_name if line.quantity_uom else None,
+                    costs['unit_cost'][line.id],
+                    costs['total_cost'][line.id]]
+
+        def batches():
+            last_id = 0
+            while True:
+                lines = cls.search([domain, ('id', '>', last_id)],
+                    order=[('id', 'ASC')], limit=batch_size)
+                if not lines:
+                    break
+                yield lines
+                last_id = lines[-1].id
+
+        count = 0
+        if format == 'csv':
+            with open(path, 'w', newline='', encoding='utf-8') as file_:
+                writer = csv.writer(file_)
+                writer.writerow(header)
+                for lines in batches():
+                    writer.writerows(rows(lines))
+                    count += len(lines)
+        else:
+            digits = cls.total_cost.digits
+
+            def arrow_type(type_):
+                if type_ == 'decimal':
+                    return pyarrow.decimal128(*digits)
+                return getattr(pyarrow, type_)()
+            schema = pyarrow.schema(
+                [(n, arrow_type(t)) for n, t in columns])
+            with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+                for lines in batches():
+                    writer.write_table(pyarrow.Table.from_pylist(
+                            [dict(zip(header, r)) for r in rows(lines)],
+                            schema=schema))
+                    count += len(lines)
+        return count
+
+    @classmethod
+    def on_modification(cls, mode, lines, field_names=None):
+        pool = Pool()
+        Plan = pool.get('product.cost.plan')
+        super().on_modification(mode, lines, field_names=field_names)
+        if mode == 'create' or (mode == 'write' and field_names
+                & cls._cost_rate_fields()):
+            cls.update_cost_rates(lines)
+        if mode in {'create', 'write'}:
+            Plan.update_operations_cost(list({l.plan for l in lines}))
+
+    @classmethod
+    def _cost_rate_fields(cls):
+        'Return the fields on which the stored rates depend'
+        return {'plan', 'work_center_category', 'work_center', 'calculation',
+            'time', 'time_uom', 'quantity', 'quantity_uom'}
+
+    @classmethod
+    def update_cost_rates(cls, lines):
+        '''
+        Store the time in rate UoM, the time cost and the quantity in plan UoM
+        of lines
+        '''
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        # The stored rates are always the current ones
+        with Transaction().set_context(cost_date=None):
+            values = cls._get_cost_values([l.id for l in lines])
+        convert = cls._get_converter()
+        # Lines of the same route operations share their rates
+        by_rates = defaultdict(list)
+        for line_id, value in values.items():
+            by_rates[cls._compute_cost_rates(value, convert)].append(line_id)
+        for (rate_time, time_cost, plan_uom_quantity), ids in (
+                by_rates.items()):
+            for sub_ids in grouped_slice(ids):
+                cursor.execute(*table.update(
+                        [table.rate_time, table.time_cost,
+                            table.plan_uom_quantity,
+                            table.cost_rates_outdated],
+                        [rate_time, time_cost, plan_uom_quantity, False],
+                        where=reduce_ids(table.id, sub_ids)))
+
+    @classmethod
+    def mark_cost_rates_outdated(cls, line_ids):
+        '''
+        Flag the stored time cost of the lines as outdated.
+        The getters compute it from the current rates while the SQL search
+        and order keep using the stored value until it is refreshed.
+        '''
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        for sub_ids in grouped_slice(line_ids):
+            cursor.execute(*table.update(
+                    [table.cost_rates_outdated], [True],
+                    where=reduce_ids(table.id, sub_ids)))
+
+    @classmethod
+    def outdate_cost_rates(cls, line_ids):
+        '''
+        Flag the stored rates of the lines as outdated, clear the stored
+        operations cost of their plans and queue their refresh.
+        The plans having already outdated lines have a refresh pending so
+        they are not queued again.
+        '''
+        pool = Pool()
+        Plan = pool.get('product.cost.plan')
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        plan_ids = set()
+        for sub_ids in grouped_slice(line_ids):
+            cursor.execute(*table.select(table.plan,
+                    where=reduce_ids(table.id, sub_ids),
+                    group_by=table.plan))
+            plan_ids.update(i for i, in cursor)
+        pending = set()
+        for sub_ids in grouped_slice(plan_ids):
+            cursor.execute(*table.select(table.plan,
+                    where=reduce_ids(table.plan, sub_ids)
+                    & (table.cost_rates_outdated == Literal(True)),
+                    group_by=table.plan))
+            pending.update(i for i, in cursor)
+
+        cls.mark_cost_rates_outdated(line_ids)
+        Plan.invalidate_operations_cost(list(plan_ids))
+        Plan.queue_refresh_operations_cost(
+            Plan.browse(list(plan_ids - pending)))
+
+    @classmethod
+    def _get_cost_rate(cls, value):
+        '''
+        Return the UoM and the cost price pricing the time for the value
+        returned by _get_cost_values, the work center is used before its
+        category
+        '''
+        if (value['work_center']
+                and value['work_center_cost_price'] is not None):
+            return value['work_center_uom'], value['work_center_cost_price']
+        if value['work_center_category']:
+            return value['category_uom'], value['cost_price']
+        return None, None
+
+    @classmethod
+    def _compute_cost_rates(cls, value, convert):
+        '''
+        Return the time in the rate UoM, the time cost and the quantity in
+        plan UoM for the value returned by _get_cost_values
+        '''
+        rate_time = time_cost = plan_uom_quantity = None
+        rate_uom, cost_price = cls._get_cost_rate(value)
+        if rate_uom and value['time']:
+            rate_time = convert(value['time_uom'], value['time'], rate_uom)
+            time_cost = Decimal(str(rate_time)) * cost_price
+        if value['calculation'] == 'standard' and value['quantity']:
+            plan_uom_quantity = convert(value['quantity_uom'],
+                value['quantity'], value['plan_uom'])
+        return rate_time, time_cost, plan_uom_quantity
+
+    @classmethod
+    def on_write(cls, lines, values):
+        pool = Pool()
+        Plan = pool.get('product.cost.plan')
+        callback = super().on_write(lines, values)
+        if 'plan' in values:
+            plans = list({l.plan for l in lines})
+            callback.append(lambda: Plan.update_operations_cost(plans))
+        return callback
+
+    @classmethod
+    def on_delete(cls, lines):
+        pool = Pool()
+        Plan = pool.get('product.cost.plan')
+        callback = super().on_delete(lines)
+        plans = list({l.plan for l in lines})
+        if plans:
+            callback.append(lambda: Plan.update_operations_cost(plans))
+        return callback
+
+    @classmethod
+    def _get_cost_values(cls, ids, key='id'):
+        '''
+        Return the values needed to compute the cost of the lines by id
+        selecting the lines whose column key is in ids.
+        The category cost prices are those effective at the cost_date of the
+        context if any.
+        '''
+        pool = Pool()
+        Plan = pool.get('product.cost.plan')
+        Category = pool.get('production.work_center.category')
+        WorkCenter = pool.get('production.work_center')
+        line = cls.__table__()
+        plan = Plan.__table__()
+        category = Category.__table__()
+        work_center = WorkCenter.__table__()
+        cursor = Transaction().connection.cursor()
+
+        values = {}
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*line.join(plan,
+                    condition=line.plan == plan.id
+                    ).join(category, 'LEFT',
+                    condition=line.work_center_category == category.id
+                    ).join(work_center, 'LEFT',
+                    condition=line.work_center == work_center.id
+                    ).select(
+                    line.id, line.plan, line.calculation,
+                    line.time, line.time_uom,
+                    line.quantity, line.quantity_uom,
+                    line.time_cost, line.plan_uom_quantity,
+                    line.cost_rates_outdated,
+                    plan.quantity, plan.production_quantity, plan.uom,
+                    category.id, category.uom, category.cost_price,
+                    work_center.id, work_center.uom, work_center.cost_price,
+                    where=reduce_ids(getattr(line, key), sub_ids)))
+            for (line_id, plan_id, calculation, time, time_uom, quantity,
+                    quantity_uom, time_cost, plan_uom_quantity, outdated,
+                    plan_quantity, production_quantity, plan_uom,
+                    category_id, category_uom, cost_price,
+                    work_center_id, work_center_uom,
+                    work_center_cost_price) in cursor:
+                if (cost_price is not None
+                        and not isinstance(cost_price, Decimal)):
+                    cost_price = Decimal(str(cost_price))
+                if (work_center_cost_price is not None
+                        and not isinstance(work_center_cost_price, Decimal)):
+                    work_center_cost_price = Decimal(
+                        str(work_center_cost_price))
+                if outdated:
+                    time_cost = None
+                elif (time_cost is not None
+                        and not isinstance(time_cost, Decimal)):
+                    time_cost = Decimal(str(time_cost))
+                values[line_id] = {
+                    'plan': plan_id,
+                    'calculation': calculation,
+                    'time': time,
+                    'time_uom': time_uom,
+                    'quantity': quantity,
+                    'quantity_uom': quantity_uom,
+                    'time_cost': time_cost,
+                    'plan_uom_quantity': plan_uom_quantity,
+                    'plan_quantity': plan_quantity,
+                    'production_quantity': production_quantity,
+                    'plan_uom': plan_uom,
+                    'work_center_category': category_id,
+                    'category_uom': category_uom,
+                    'cost_price': cost_price,
+                    'work_center': work_center_id,
+                    'work_center_uom': work_center_uom,
+                    'work_center_cost_price': work_center_cost_price,
+                    }
+        date = Transaction().context.get('cost_date')
+        if date:
+            cls._set_dated_cost_prices(values, date)
+        return values
+
+    @classmethod
+    def _complete_cost_values(cls, values):
+        '''
+        Complete the values of lines which are not stored with the rates of
+        their work center and category to be like those of _get_cost_values.
+        The work centers and categories of all the lines are read at once.
+        '''
+        pool = Pool()
+        Category = pool.get('production.work_center.category')
+        WorkCenter = pool.get('production.work_center')
+
+        categories = {c.id: c for c in Category.browse(list(
+                    {v['work_center_category'] for v in values.values()
+                        if v['work_center_category']}))}
+        work_centers = {w.id: w for w in WorkCenter.browse(list(
+                    {v['work_center'] for v in values.values()
+                        if v['work_center']}))}
+        for value in values.values():
+            category = categories.get(value['work_center_category'])
+            work_center = work_centers.get(value['work_center'])
+            value.update({
+                    'time_cost': None,
+                    'plan_uom_quantity': None,
+                    'category_uom': (
+                        category.uom.id if category and category.uom
+                        else None),
+                    'cost_price': category.cost_price if category else None,
+                    'work_center_uom': (
+                        work_center.uom.id if work_center and work_center.uom
+                        else None),
+                    'work_center_cost_price': (
+                        work_center.cost_price if work_center else None),
+                    })
+        date = Transaction().context.get('cost_date')
+        if date:
+            cls._set_dated_cost_prices(values, date)
+        return values
+
+    @classmethod
+    def _set_dated_cost_prices(cls, values, date):
+        '''
+        Replace the category cost prices of the values returned by
+        _get_cost_values by the rates effective at date
+        '''
+        pool = Pool()
+        Rate = pool.get('production.work_center.category.rate')
+        cost_prices = Rate.get_cost_prices(
+            {v['work_center_category'] for v in values.values()
+                if v['work_center_category']}, date)
+        for value in values.values():
+            category_id = value['work_center_category']
+            if category_id in cost_prices:
+                value['cost_price'] = cost_prices[category_id]
+                # The stored time cost is at the current rate
+                value['time_cost'] = None
+
+    @classmethod
+    def _get_converter(cls):
+        '''
+        Return a function converting a quantity between two UoM ids like
+        compute_qty without rounding
+        '''
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        conversions = {}
+
+        def convert(from_id, qty, to_id):
+            if from_id is None or to_id is None:
+                return compute_qty(from_id and Uom(from_id), qty,
+                    to_id and Uom(to_id))
+            key = (from_id, to_id)
+            if key not in conversions:
+                conversions[key] = get_conversion(Uom(from_id), Uom(to_id))
+            return convert_qty(conversions[key], qty)
+        return convert
+
+    @classmethod
+    def _get_engine_data(cls, values, quantities=None):
+        '''
+        Return the engine plans and operations for the values returned by
+        _get_cost_values and the plan quantities by id.
+        The stored time cost and quantity in plan UoM are used when they are
+        set otherwise they are computed from the values.
+        '''
+        plans = engine.Plans()
+        operations = engine.Operations()
+        convert = None
+        for line_id, value in values.items():
+            plan = plans.add(value['plan'], value['plan_quantity'],
+                value['production_quantity'])
+            time_cost = value['time_cost']
+            plan_uom_quantity = value['plan_uom_quantity']
+            if (not cls._get_cost_rate(value)[0]
+                    or not value['time']):
+                time_cost = None
+            elif (time_cost is None
+                    or (value['calculation'] == 'standard'
+                        and plan_uom_quantity is None)):
+                if convert is None:
+                    convert = cls._get_converter()
+                _, time_cost, plan_uom_quantity = cls._compute_cost_rates(
+                    value, convert)
+            if value['calculation'] == 'standard' and not value['quantity']:
+                plan_uom_quantity = None
+            operations.add(line_id, plan, value['calculation'],
+                plan_uom_quantity, time_cost)
+        # Plans without lines
+        for plan_id, quantity in (quantities or {}).items():
+            plans.add(plan_id, quantity, None)
+        return plans, operations
+
 
 class Plan(metaclass=PoolMeta):
     __name__ = 'product.cost.plan'
@@ -182,39 +825,432 @@ class Plan(metaclass=PoolMeta):
         depends=['uom_digits'])
     operations_cost = fields.Function(fields.Numeric('Unit Operation Costs',
             digits=DIGITS),
-        'get_operations_cost')
+        'get_operations_cost', searcher='search_operations_cost')
+    operations_cost_cache = fields.Numeric('Unit Operation Costs Cache',
+        digits=DIGITS, readonly=True)
+    rollup_operations_cost = fields.Function(fields.Numeric(
+            'Unit Operation Costs with Components', digits=DIGITS,
+            help="The operation costs of the plan including those of the "
+            "plans of its BOM inputs."),
+        'get_rollup_operations_cost')
+    drifted = fields.Function(fields.Boolean('Drifted from Route',
+            help="The operation lines differ from the operations of the "
+            "route."),
+        'get_drifted', searcher='search_drifted')
+    route_operations_cost = fields.Function(fields.Numeric(
+            'Unit Operation Costs of Route', digits=DIGITS,
+            help="The operation costs once recomputed from the route."),
+        'get_route_operations_cost')
+    operations_cost_drift = fields.Function(fields.Numeric(
+            'Unit Operation Costs Drift', digits=DIGITS,
+            help="The change of the operation costs once recomputed from the "
+            "route."),
+        'get_route_operations_cost')
 
     @classmethod
     def __setup__(cls):
         super(Plan, cls).__setup__()
         cls.uom.states['readonly'] = (cls.uom.states['readonly']
             | Eval('operations', [0]))
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t, (t.route, Index.Range()), where=t.route != Null))
 
     @fields.depends('quantity')
     def on_change_with_production_quantity(self):
         return self.quantity
 
-    def get_operations_cost(self, name):
-        if not self.quantity:
-            return Decimal(0)
-        cost = sum(o.get_total_cost(None, round=False)
-            for o in self.operations)
-        cost /= Decimal(str(self.quantity))
-        digits = self.__class__.operations_cost.digits[1]
-        return cost.quantize(Decimal(str(10 ** -digits)))
+    @fields.depends(methods=['_get_operations_cost_preview_values'])
+    def on_change_with_operations_cost(self, name=None):
+        # Preview of the edited lines computed in one call for all of them
+        values = self._get_operations_cost_preview_values()
+        return self._get_operations_cost_from_values(
+            {0: self.quantity}, values)[0]
+
+    @fields.depends('quantity', 'production_quantity', 'uom', 'operations')
+    def _get_operations_cost_preview_values(self):
+        '''
+        Return the values like _get_cost_values of the edited operation lines
+        keyed by their position and with 0 as plan
+        '''
+        OperationLine = Pool().get('product.cost.plan.operation_line')
+
+        def id_(record):
+            return record.id if record else None
+
+        values = {}
+        for i, line in enumerate(self.operations or []):
+            values[i] = {
+                'plan': 0,
+                'calculation': line.calculation,
+                'time': line.time,
+                'time_uom': id_(line.time_uom),
+                'quantity': line.quantity,
+                'quantity_uom': id_(line.quantity_uom),
+                'work_center_category': id_(line.work_center_category),
+                'work_center': id_(line.work_center),
+                'plan_quantity': self.quantity,
+                'production_quantity': self.production_quantity,
+                'plan_uom': id_(self.uom),
+                }
+        return OperationLine._complete_cost_values(values)
+
+    @classmethod
+    def get_operations_cost(cls, plans, name):
+        with measure('plan.get_operations_cost') as stats:
+            stats.rows_read += len(plans)
+            return cls._get_operations_cost(plans)
+
+    @classmethod
+    def _get_operations_cost(cls, plans):
+        # The cache stores the operations cost at the current rates
+        if (not OPERATIONS_COST_CACHE
+                or Transaction().context.get('cost_date')):
+            return cls._compute_operations_cost(plans)
+
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        result = {}
+        for sub_plans in grouped_slice(plans):
+            cursor.execute(*table.select(
+                    table.id, table.operations_cost_cache,
+                    where=reduce_ids(table.id, [p.id for p in sub_plans])
+                    & (table.operations_cost_cache != None)))
+            for plan_id, cost in cursor:
+                if not isinstance(cost, Decimal):
+                    cost = Decimal(str(cost))
+                result[plan_id] = cost
+        missing = [p for p in plans if p.id not in result]
+        if missing:
+            result.update(cls._compute_operations_cost(missing))
+        return result
+
+    @classmethod
+    def _get_operations_cost_column(cls, plan):
+        '''
+        Return the SQL expression of the operations cost of the plan table
+        '''
+        pool = Pool()
+        OperationLine = pool.get('product.cost.plan.operation_line')
+        line = OperationLine.__table__()
+        total = line.select(
+            Sum(OperationLine._get_total_cost_column(line, plan)),
+            where=line.plan == plan.id)
+        return Round(cls.operations_cost.sql_cast(
+                Coalesce(Coalesce(total, 0) / NullIf(plan.quantity, 0), 0)),
+            cls.operations_cost.digits[1])
+
+    @classmethod
+    def search_operations_cost(cls, name, clause):
+        plan = cls.__table__()
+        _, operator, value = clause
+        Operator = fields.SQL_OPERATORS[operator]
+        value = _sql_format(cls.operations_cost, value)
+        query = plan.select(plan.id,
+            where=Operator(cls._get_operations_cost_column(plan), value))
+        return [('id', 'in', query)]
+
+    @classmethod
+    def order_operations_cost(cls, tables):
+        plan, _ = tables[None]
+        return [cls._get_operations_cost_column(plan)]
+
+    @classmethod
+    def get_rollup_operations_cost(cls, plans, name):
+        with measure('plan.get_rollup_operations_cost') as stats:
+            return cls._get_rollup_operations_cost(plans, stats)
+
+    @classmethod
+    def _get_rollup_operations_cost(cls, plans, stats):
+        digits = engine.quantizer(cls.operations_cost.digits[1])
+
+        # Load the component DAG level by level so each plan is read once
+        components = {}
+        level = list(plans)
+        while level:
+            level_components = cls._get_component_plans(level)
+            components.update(level_components)
+            level = {c.id: c for l in level_components.values()
+                for c, _ in l if c.id not in components}
+            level = list(level.values())
+        stats.rows_read += len(components)
+        costs = cls._get_operations_cost(cls.browse(list(components)))
+
+        # Evaluate the plans in topological order, components first
+        rollup = {}
+        for plan in plans:
+            stack = [(plan.id, False)]
+            visiting = set()
+            while stack:
+                plan_id, expanded = stack.pop()
+                if plan_id in rollup:
+                    continue
+                if expanded:
+                    visiting.discard(plan_id)
+                    cost = costs[plan_id]
+                    for component, quantity in components[plan_id]:
+                        # A component in a cycle is not rolled up
+                        cost += (rollup.get(component.id, _ZERO)
+                            * Decimal(str(quantity)))
+                    rollup[plan_id] = cost.quantize(digits)
+                elif plan_id not in visiting:
+                    visiting.add(plan_id)
+                    stack.append((plan_id, True))
+                    for component, _ in components[plan_id]:
+                        if (component.id not in rollup
+                                and component.id not in visiting):
+                            stack.append((component.id, False))
+        return {p.id: rollup[p.id] for p in plans}
+
+    @classmethod
+    def _get_component_plans(cls, plans):
+        '''
+        Return for each plan id the list of its component plans with their
+        quantity in the component plan UoM for one unit of the plan UoM.
+        The component plan of a BOM input is the last plan of its product.
+        '''
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        inputs, product_ids = {}, set()
+        for plan in plans:
+            inputs[plan.id] = []
+            if not plan.bom or not plan.product or not plan.uom:
+                continue
+            output_quantity = sum(
+                compute_qty(o.unit, o.quantity, plan.uom)
+                for o in plan.bom.outputs if o.product == plan.product)
+            if not output_quantity:
+                continue
+            for input_ in plan.bom.inputs:
+                inputs[plan.id].append((input_, output_quantity))
+                product_ids.add(input_.product.id)
+
+        plan_ids = {}
+        for sub_ids in grouped_slice(product_ids):
+            cursor.execute(*table.select(table.product, Max(table.id),
+                    where=reduce_ids(table.product, sub_ids),
+                    group_by=table.product))
+            plan_ids.update(cursor)
+        component_plans = {p.product.id: p
+            for p in cls.browse(list(plan_ids.values()))}
+
+        result = {}
+        for plan_id, plan_inputs in inputs.items():
+            result[plan_id] = []
+            for input_, output_quantity in plan_inputs:
+                component = component_plans.get(input_.product.id)
+                if not component or component.id == plan_id:
+                    continue
+                quantity = compute_qty(input_.unit, input_.quantity,
+                    component.uom)
+                result[plan_id].append(
+                    (component, quantity / output_quantity))
+        return result
+
+    @classmethod
+    def _compute_operations_cost(cls, plans):
+        OperationLine = Pool().get('product.cost.plan.operation_line')
+        values = OperationLine._get_cost_values(
+            [p.id for p in plans], key='plan')
+        return cls._get_operations_cost_from_values(
+            {p.id: p.quantity for p in plans}, values)
+
+    @classmethod
+    def _get_operations_cost_from_values(cls, quantities, values):
+        '''
+        Return the operations cost by plan id for the plan quantities and the
+        operation line values returned by _get_cost_values
+        '''
+        OperationLine = Pool().get('product.cost.plan.operation_line')
+        plans, operations = OperationLine._get_engine_data(
+            values, quantities)
+        costs = engine.plan_costs(plans, operations,
+            cls.operations_cost.digits[1])
+        return {i: costs[plans.position(i)] for i in quantities}
+
+    @classmethod
+    def get_operations_cost_curve(cls, plans, quantities):
+        '''
+        Return for each plan id the list of its unit operations cost at each
+        of the quantities.
+        The operation lines are read and their rates computed once whatever
+        the number of quantities.
+        '''
+        OperationLine = Pool().get('product.cost.plan.operation_line')
+        with measure('plan.get_operations_cost_curve') as stats:
+            values = OperationLine._get_cost_values(
+                [p.id for p in plans], key='plan')
+            stats.rows_read += len(values)
+            engine_plans, operations = OperationLine._get_engine_data(
+                values, {p.id: p.quantity for p in plans})
+            curves = engine.cost_curves(engine_plans, operations, quantities,
+                cls.operations_cost.digits[1])
+        return {p.id: curves[engine_plans.position(p.id)] for p in plans}
+
+    @classmethod
+    def simulate_operations_cost(cls, plans, cost_prices=None,
+            quantities=None, production_quantities=None, times=None):
+        '''
+        Return for each plan id a tuple of the current operations cost, the
+        simulated one and their difference without writing anything.
+
+        The simulation overrides the cost price by work center category id
+        of the lines without work center rate, the quantity and production
+        quantity by plan id and the time by operation line id.
+        '''
+        OperationLine = Pool().get('product.cost.plan.operation_line')
+        cost_prices = cost_prices or {}
+        quantities = quantities or {}
+        production_quantities = production_quantities or {}
+        times = times or {}
+
+        values = OperationLine._get_cost_values(
+            [p.id for p in plans], key='plan')
+        plan_quantities = {p.id: p.quantity for p in plans}
+        current = cls._get_operations_cost_from_values(
+            plan_quantities, values)
+
+        simulated_values = {}
+        for line_id, value in values.items():
+            value = value.copy()
+            plan_id = value['plan']
+            if plan_id in quantities:
+                value['plan_quantity'] = quantities[plan_id]
+            if plan_id in production_quantities:
+                value['production_quantity'] = production_quantities[plan_id]
+            if value['work_center_category'] in cost_prices:
+                cost_price = cost_prices[value['work_center_category']]
+                if not isinstance(cost_price, Decimal):
+                    cost_price = Decimal(str(cost_price))
+                value['cost_price'] = cost_price
+                value['time_cost'] = None
+            if line_id in times:
+                value['time'] = times[line_id]
+                value['time_cost'] = None
+            simulated_values[line_id] = value
+        simulated = cls._get_operations_cost_from_values({
+                i: quantities.get(i, q) for i, q in plan_quantities.items()},
+            simulated_values)
+
+        return {i: (current[i], simulated[i], simulated[i] - current[i])
+            for i in plan_quantities}
+
+    @classmethod
+    def update_operations_cost(cls, plans):
+        '''
+        Store the operations cost of plans when the cache is enabled otherwise
+        clear it so no stale cost is read once the cache is enabled again
+        '''
+        if not plans:
+            return
+        if not OPERATIONS_COST_CACHE:
+            cls.invalidate_operations_cost([p.id for p in plans])
+            return
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        # Ignore plans deleted in the meantime
+        plans = cls.browse(
+            [p.id for p in plans if p.id not in cls._deleted_ids()])
+        with Transaction().set_context(cost_date=None):
+            costs = cls._compute_operations_cost(plans)
+        by_cost = defaultdict(list)
+        for plan_id, cost in costs.items():
+            by_cost[cost].append(plan_id)
+        for cost, ids in by_cost.items():
+            for sub_ids in grouped_slice(ids):
+                cursor.execute(*table.update(
+                        [table.operations_cost_cache], [cost],
+                        where=reduce_ids(table.id, sub_ids)))
+
+    @classmethod
+    def invalidate_operations_cost(cls, plan_ids):
+        'Clear the stored operations cost of the plans'
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        for sub_ids in grouped_slice(plan_ids):
+            cursor.execute(*table.update(
+                    [table.operations_cost_cache], [None],
+                    where=reduce_ids(table.id, sub_ids)))
+
+    @classmethod
+    def queue_refresh_operations_cost(cls, plans):
+        '''
+        Push to the task queue the refresh of the stored costs of plans.
+        The tasks are delayed by recompute_delay seconds so a burst of changes
+        is refreshed once.
+        '''
+        if not plans:
+            return
+        with Transaction().set_context(
+                queue_name='product_cost_plan',
+                queue_scheduled_at=datetime.timedelta(
+                    seconds=RECOMPUTE_DELAY),
+                queue_batch=RECOMPUTE_BATCH):
+            cls.__queue__.refresh_operations_cost(plans)
+
+    @classmethod
+    def refresh_operations_cost(cls, plans):
+        'Recompute the outdated stored costs of plans'
+        pool = Pool()
+        OperationLine = pool.get('product.cost.plan.operation_line')
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        lines = []
+        for sub_plans in grouped_slice(plans):
+            lines.extend(OperationLine.search([
+                        ('plan', 'in', [p.id for p in sub_plans]),
+                        ('cost_rates_outdated', '=', True),
+                        ]))
+        if lines:
+            OperationLine.update_cost_rates(lines)
+        outdated = {l.plan.id for l in lines}
+        if OPERATIONS_COST_CACHE:
+            for sub_plans in grouped_slice(plans):
+                cursor.execute(*table.select(table.id,
+                        where=reduce_ids(table.id, [p.id for p in sub_plans])
+                        & (table.operations_cost_cache == Null)))
+                outdated.update(i for i, in cursor)
+        cls.update_operations_cost(cls.browse(list(outdated)))
+        logger.info("refreshed operations cost of %s cost plans",
+            len(outdated))
+
+    @classmethod
+    def _deleted_ids(cls):
+        return Transaction().delete_records.get(cls.__name__, set())
+
+    @classmethod
+    def on_modification(cls, mode, plans, field_names=None):
+        pool = Pool()
+        OperationLine = pool.get('product.cost.plan.operation_line')
+        super().on_modification(mode, plans, field_names=field_names)
+        if mode == 'write' and 'uom' in field_names:
+            OperationLine.update_cost_rates(OperationLine.search([
+                        ('plan', 'in', [p.id for p in plans]),
+                        ]))
+        if mode == 'create' or (mode == 'write' and field_names
+                & {'quantity', 'production_quantity', 'uom'}):
+            cls.update_operations_cost(plans)
 
     @classmethod
     def clean(cls, plans):
         pool = Pool()
         OperationLine = pool.get('product.cost.plan.operation_line')
+        line = OperationLine.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
 
         super(Plan, cls).clean(plans)
 
-        operation_lines = OperationLine.search([
-                ('plan', 'in', [p.id for p in plans]),
-                ])
-        if operation_lines:
-            OperationLine.delete(operation_lines)
+        with measure('plan.clean') as stats:
+            for sub_ids in grouped_slice([p.id for p in plans]):
+                cursor.execute(*line.delete(
+                        where=reduce_ids(line.plan, sub_ids)))
+                stats.rows_written += max(cursor.rowcount, 0)
+        # Invalidate the records cached with the deleted lines
+        transaction.counter += 1
+        cls.update_operations_cost(plans)
 
     @classmethod
     def compute(cls, plans):
@@ -222,52 +1258,408 @@ class Plan(metaclass=PoolMeta):
 
         super(Plan, cls).compute(plans)
 
-        to_create = []
+        with measure('plan.compute') as stats:
+            route_operations = cls._get_route_operations_values(
+                {p.route.id for p in plans if p.route})
+            stats.rows_read += sum(map(len, route_operations.values()))
+            to_create = []
+            for plan in plans:
+                if not plan.route:
+                    continue
+                for values in route_operations[plan.route.id]:
+                    values = values.copy()
+                    values['plan'] = plan.id
+                    to_create.append(values)
+            if to_create:
+                OperationLine.create(to_create)
+            stats.rows_written += len(to_create)
+
+    @classmethod
+    def recompute_all(cls):
+        '''
+        Recompute all cost plans dispatching batches of plans to the task
+        queue so each batch runs in its own transaction and worker
+        '''
+        plans = cls.search(cls._get_recompute_domain())
+        tasks = cls._queue_recompute(plans)
+        logger.info("queued %s cost plans to recompute in %s tasks",
+            len(plans), tasks)
+
+    @classmethod
+    def _queue_recompute(cls, plans):
+        '''
+        Queue the recompute of plans by batches and return the number of
+        tasks queued.
+        The tasks know when the run was queued and its size so they report
+        the progress of the whole run.
+        '''
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*Select([CurrentTimestamp()]))
+        enqueued_at, = cursor.fetchone()
+        with Transaction().set_context(
+                queue_name=RECOMPUTE_QUEUE,
+                queue_batch=RECOMPUTE_BATCH,
+                recompute_enqueued_at=enqueued_at,
+                recompute_queued_at=time.time(),
+                recompute_plans=len(plans)):
+            task_ids = cls.__queue__.recompute(plans)
+        return len(task_ids or [])
+
+    @classmethod
+    def _get_recompute_domain(cls):
+        'Return the domain of the plans recomputed by recompute_all'
+        return []
+
+    @classmethod
+    def recompute(cls, plans):
+        start = time.monotonic()
+        try:
+            cls.clean(plans)
+            cls.compute(plans)
+        except Exception:
+            logger.exception("failed to recompute cost plans %s",
+                [p.id for p in plans])
+            raise
+        duration = time.monotonic() - start
+        logger.info("recomputed %s cost plans in %.3fs (%.1f plans/s)",
+            len(plans), duration, len(plans) / duration if duration else 0)
+        cls._log_recompute_progress()
+
+    @classmethod
+    def _log_recompute_progress(cls):
+        '''
+        Log the number of tasks of the recompute run remaining after the
+        current one and the figures of the whole run when none remains
+        '''
+        pool = Pool()
+        Queue = pool.get('ir.queue')
+        context = Transaction().context
+        enqueued_at = context.get('recompute_enqueued_at')
+        if not enqueued_at:
+            return
+        # The current task is not yet finished and the tasks running
+        # concurrently are counted until they are committed
+        remaining = Queue.search_count([
+                ('name', '=', RECOMPUTE_QUEUE),
+                ('enqueued_at', '>=', enqueued_at),
+                ('finished_at', '=', None),
+                ]) - 1
+        if remaining > 0:
+            logger.info("%s tasks of the recompute run remaining", remaining)
+        else:
+            elapsed = time.time() - context['recompute_queued_at']
+            total = context.get('recompute_plans', 0)
+            logger.info("recomputed the %s cost plans of the run in %.3fs "
+                "(%.1f plans/s)", total, elapsed,
+                total / elapsed if elapsed else 0)
+
+    @classmethod
+    def sync_route(cls, plans):
+        '''
+        Update the operation lines of plans to match their route.
+        Lines and route operations are paired by sequence and operation type,
+        only the lines that differ are written and the missing or extra lines
+        are created or deleted.
+        '''
+        pool = Pool()
+        OperationLine = pool.get('product.cost.plan.operation_line')
+
+        plans = [p for p in plans if p.route]
+        route_operations = cls._get_route_operations_values(
+            {p.route.id for p in plans})
+        plan_lines = defaultdict(list)
+        for sub_plans in grouped_slice(plans):
+            for line in OperationLine.search([
+                        ('plan', 'in', [p.id for p in sub_plans]),
+                        ], order=[('plan', 'ASC'), ('sequence', 'ASC'),
+                        ('id', 'ASC')]):
+                plan_lines[line.plan.id].append(line)
+
+        def line_value(line, name):
+            value = getattr(line, name)
+            if isinstance(value, ModelSQL):
+                value = value.id
+            return value
+
+        to_create, to_write, to_delete = [], [], []
         for plan in plans:
-            if not plan.route:
-                continue
-            for operation in plan.route.operations:
-                line = OperationLine()
-                for field in ('sequence', 'operation_type',
-                        'work_center_category', 'calculation',
-                        'time_uom', 'time',
-                        'quantity_uom', 'quantity_uom_digits', 'quantity'):
-                    setattr(line, field, getattr(operation, field))
-                line.plan = plan
-                to_create.append(line._save_values())
+            pending = defaultdict(list)
+            for line in plan_lines[plan.id]:
+                key = (line.sequence, line_value(line, 'operation_type'))
+                pending[key].append(line)
+            for values in route_operations[plan.route.id]:
+                key = (values['sequence'], values['operation_type'])
+                if pending[key]:
+                    line = pending[key].pop(0)
+                    changes = {n: v for n, v in values.items()
+                        if line_value(line, n) != v}
+                    if changes:
+                        to_write.extend(([line], changes))
+                else:
+                    values = values.copy()
+                    values['plan'] = plan.id
+                    to_create.append(values)
+            for lines in pending.values():
+                to_delete.extend(lines)
+        if to_delete:
+            OperationLine.delete(to_delete)
+        if to_write:
+            OperationLine.write(*to_write)
         if to_create:
             OperationLine.create(to_create)
 
-    def create_route(self, name):
+    @classmethod
+    def get_route_plan_ids(cls, routes):
+        'Return the ids of the plans using routes and having operation lines'
+        pool = Pool()
+        OperationLine = pool.get('product.cost.plan.operation_line')
+        table = cls.__table__()
+        line = OperationLine.__table__()
+        cursor = Transaction().connection.cursor()
+
+        plan_ids = []
+        for sub_ids in grouped_slice([r.id for r in routes]):
+            cursor.execute(*table.select(table.id,
+                    where=reduce_ids(table.route, sub_ids)
+                    & Exists(line.select(line.id,
+                            where=line.plan == table.id))))
+            plan_ids.extend(i for i, in cursor)
+        return plan_ids
+
+    @classmethod
+    def _get_drift_condition(cls, plan):
+        '''
+        Return the SQL condition of the plan table for the plans having
+        operation lines which no longer match the operations of their route
+        '''
+        pool = Pool()
+        OperationLine = pool.get('product.cost.plan.operation_line')
+        Operation = pool.get('production.route.operation')
+        names = cls._get_route_operation_fields()
+
+        def match(line, operation):
+            condition = ((line.plan == plan.id)
+                & (operation.route == plan.route))
+            for name in names:
+                line_value = getattr(line, name)
+                operation_value = getattr(operation, name)
+                condition &= ((line_value == operation_value)
+                    | ((line_value == Null) & (operation_value == Null)))
+            return condition
+
+        line = OperationLine.__table__()
+        operation = Operation.__table__()
+        missing_operation = line.select(line.id,
+            where=(line.plan == plan.id)
+            & ~Exists(operation.select(operation.id,
+                    where=match(line, operation))))
+
+        line = OperationLine.__table__()
+        operation = Operation.__table__()
+        missing_line = operation.select(operation.id,
+            where=(operation.route == plan.route)
+            & ~Exists(line.select(line.id, where=match(line, operation))))
+
+        line = OperationLine.__table__()
+        operation = Operation.__table__()
+        line_count = line.select(Count(Literal('*')),
+            where=line.plan == plan.id)
+        operation_count = operation.select(Count(Literal('*')),
+            where=operation.route == plan.route)
+
+        line = OperationLine.__table__()
+        return ((plan.route != Null)
+            & Exists(line.select(line.id, where=line.plan == plan.id))
+            & (Exists(missing_operation) | Exists(missing_line)
+                | (Coalesce(line_count, 0) != Coalesce(operation_count, 0))))
+
+    @classmethod
+    def get_drifted(cls, plans, name):
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        result = {p.id: False for p in plans}
+        with measure('plan.get_drifted') as stats:
+            for sub_ids in grouped_slice([p.id for p in plans]):
+                cursor.execute(*table.select(table.id,
+                        where=reduce_ids(table.id, sub_ids)
+                        & cls._get_drift_condition(table)))
+                for plan_id, in cursor:
+                    result[plan_id] = True
+            stats.rows_read += len(plans)
+        return result
+
+    @classmethod
+    def search_drifted(cls, name, clause):
+        table = cls.__table__()
+        _, operator, value = clause
+        if operator not in {'=', '!='}:
+            raise ValueError("unsupported operator %s" % operator)
+        query = table.select(table.id,
+            where=cls._get_drift_condition(table))
+        if (operator == '=') == bool(value):
+            return [('id', 'in', query)]
+        return [('id', 'not in', query)]
+
+    @classmethod
+    def get_route_operations_cost(cls, plans, names):
+        '''
+        Return the operations cost of the plans once recomputed from their
+        route and its difference with the current one
+        '''
+        OperationLine = Pool().get('product.cost.plan.operation_line')
+        result = {n: {p.id: None for p in plans} for n in names}
+        plans = [p for p in plans if p.route]
+        route_operations = cls._get_route_operations_values(
+            {p.route.id for p in plans})
+
+        values = {}
+        for plan in plans:
+            for operation in route_operations[plan.route.id]:
+                value = dict(operation, plan=plan.id,
+                    plan_quantity=plan.quantity,
+                    production_quantity=plan.production_quantity,
+                    plan_uom=plan.uom.id)
+                values[len(values)] = value
+        values = OperationLine._complete_cost_values(values)
+        route_costs = cls._get_operations_cost_from_values(
+            {p.id: p.quantity for p in plans}, values)
+        costs = cls._get_operations_cost(plans)
+
+        for plan in plans:
+            if 'route_operations_cost' in result:
+                result['route_operations_cost'][plan.id] = (
+                    route_costs[plan.id])
+            if 'operations_cost_drift' in result:
+                result['operations_cost_drift'][plan.id] = (
+                    route_costs[plan.id] - costs[plan.id])
+        return result
+
+    @classmethod
+    def recompute_drifted(cls):
+        'Queue the recompute of the plans which drifted from their route'
+        plans = cls.search([('drifted', '=', True)])
+        tasks = cls._queue_recompute(plans)
+        logger.info("queued %s drifted cost plans to recompute in %s tasks",
+            len(plans), tasks)
+
+    @classmethod
+    def _get_route_operation_fields(cls):
+        'Return the route operation fields copied into the operation lines'
+        return ['sequence', 'operation_type', 'work_center_category',
+            'work_center', 'calculation', 'time_uom', 'time', 'quantity_uom',
+            'quantity']
+
+    @classmethod
+    def _get_route_operations_values(cls, route_ids):
+        '''
+        Return the operation line values to create for each route id from the
+        snapshots of the route operations cached in the transaction
+        '''
+        pool = Pool()
+        Route = pool.get('production.route')
+        names = cls._get_route_operation_fields()
+        snapshots = Route.get_operation_snapshots(route_ids, names)
+        return {r: [dict(zip(names, o)) for o in snapshots[r]]
+            for r in route_ids}
+
+    def create_route(self, name, reuse=False):
+        route, = self.create_routes([self], [name], reuse=reuse)
+        return route
+
+    @classmethod
+    def create_routes(cls, plans, names=None, reuse=False):
+        '''
+        Create a route for each plan from its operation lines and link it to
+        the plan and to the first BOM of its product.
+        names defaults to the record name of the plans.
+        If reuse is set, an existing route with the same operations and UoM
+        is linked instead of creating a new one.
+        '''
+        with measure('plan.create_routes') as stats:
+            stats.rows_read += len(plans)
+            routes = cls._create_routes(plans, names=names, reuse=reuse)
+            stats.rows_written += len({r.id for r in routes})
+        return routes
+
+    @classmethod
+    def _create_routes(cls, plans, names=None, reuse=False):
         pool = Pool()
         Route = pool.get('production.route')
         ProductBOM = pool.get('product.product-production.bom')
         Warning = pool.get('res.user.warning')
-        key = 'route_already_exists%s'%self.id
-        if not self.product:
-            raise UserError(gettext('product_cost_plan_margin.lacks_the_product',
-                cost_plan=self.rec_name))
-        if self.route and Warning.check(key):
-            raise UserWarning(key,
-                gettext('product_cost_plan_margin.route_already_exists',
-                    product=self.rec_name))
-
-        route = Route()
-        route.name = name
-        route.uom = self.uom
-        route.operations = self._get_route_operations()
-        route.save()
-        self.route = route
-        self.save()
-
-        if self.product.boms:
-            product_bom = self.product.boms[0]
-        else:
-            product_bom = ProductBOM()
-        product_bom.product = self.product
-        product_bom.route = route
-        product_bom.save()
-        return route
+
+        if names is None:
+            names = [p.rec_name for p in plans]
+        for plan in plans:
+            if not plan.product:
+                raise UserError(gettext(
+                        'product_cost_plan_operation.lacks_the_product',
+                        cost_plan=plan.rec_name))
+        with_route = [p for p in plans if p.route]
+        if with_route:
+            key = Warning.format('route_already_exists', with_route)
+            if Warning.check(key):
+                raise UserWarning(key, gettext(
+                        'product_cost_plan_operation.route_already_exists',
+                        cost_plan=', '.join(p.rec_name for p in with_route)))
+
+        operations = [[o._save_values() for o in p._get_route_operations()]
+            for p in plans]
+        fingerprints = [Route.get_fingerprint(o) for o in operations]
+        keys = [(f, p.uom.id) if reuse else i
+            for i, (p, f) in enumerate(zip(plans, fingerprints))]
+        key2route = {}
+        if reuse:
+            for sub_keys in grouped_slice(list(set(fingerprints))):
+                for route in Route.search([
+                            ('fingerprint', 'in', list(sub_keys)),
+                            ], order=[('id', 'ASC')]):
+                    key2route.setdefault(
+                        (route.fingerprint, route.uom.id), route)
+        to_create = {}
+        for key, plan, name, values, fingerprint in zip(
+                keys, plans, names, operations, fingerprints):
+            if key not in key2route and key not in to_create:
+                to_create[key] = {
+                    'name': name,
+                    'uom': plan.uom.id,
+                    'fingerprint': fingerprint,
+                    'operations': [('create', values)],
+                    }
+        if to_create:
+            key2route.update(zip(to_create.keys(),
+                    Route.create(list(to_create.values()))))
+        routes = [key2route[k] for k in keys]
+
+        route2plans = defaultdict(list)
+        for plan, route in zip(plans, routes):
+            route2plans[route].append(plan)
+        to_write = []
+        for route, route_plans in route2plans.items():
+            to_write.extend((route_plans, {'route': route.id}))
+        cls.write(*to_write)
+
+        # Only the last route is linked when plans share the same product
+        product_routes = {}
+        for plan, route in zip(plans, routes):
+            product_routes[plan.product] = route
+        route2boms = defaultdict(list)
+        bom_to_write, bom_to_create = [], []
+        for product, route in product_routes.items():
+            if product.boms:
+                route2boms[route].append(product.boms[0])
+            else:
+                bom_to_create.append({
+                        'product': product.id,
+                        'route': route.id,
+                        })
+        for route, boms in route2boms.items():
+            bom_to_write.extend((boms, {'route': route.id}))
+        if bom_to_write:
+            ProductBOM.write(*bom_to_write)
+        if bom_to_create:
+            ProductBOM.create(bom_to_create)
+        return routes
 
     def _get_route_operations(self):
         operations = []
@@ -283,6 +1675,7 @@ class Plan(metaclass=PoolMeta):
         operation.operation_type = line.operation_type
         operation.notes = line.name
         operation.work_center_category = line.work_center_category
+        operation.work_center = line.work_center
         operation.time = line.time
         operation.time_uom = line.time_uom
         operation.calculation = line.calculation
@@ -292,29 +1685,159 @@ class Plan(metaclass=PoolMeta):
 
     @classmethod
     def copy(cls, plans, default=None):
+        pool = Pool()
+        OperationLine = pool.get('product.cost.plan.operation_line')
         if default is None:
             default = {}
         else:
             default = default.copy()
         default['route'] = None
-        return super(Plan, cls).copy(plans, default=default)
+        new_plans = super(Plan, cls).copy(plans, default=default)
 
-    def _copy_plan(self, default):
-        OperationLine = Pool().get('product.cost.plan.operation_line')
+        with measure('plan.copy') as stats:
+            plan2new = {p.id: n.id for p, n in zip(plans, new_plans)}
+            lines = OperationLine.search([
+                    ('plan', 'in', list(plan2new)),
+                    ], order=[('plan', 'ASC'), ('id', 'ASC')])
+            if lines:
+                OperationLine.copy(lines,
+                    default=cls._get_operation_line_copy_default(plan2new))
+            stats.rows_read += len(lines)
+            stats.rows_written += len(lines)
+        return new_plans
+
+    @classmethod
+    def _get_operation_line_copy_default(cls, plan2new):
+        '''
+        Return the default values to copy the operation lines of the plans
+        into the new plans given by plan2new
+        '''
+        return {
+            'plan': lambda data: plan2new[data['plan']],
+            }
 
+    def _copy_plan(self, default):
+        # Operation lines are copied for all plans at once by copy
         default['operations'] = None
-        new_plan = super(Plan, self)._copy_plan(default=default)
-        OperationLine.copy(self.operations, default={
-                'plan': new_plan.id,
-                })
-        return new_plan
+        return super(Plan, self)._copy_plan(default=default)
+
+
+class CostDateContext(ModelView):
+    'Cost Plan Cost Date Context'
+    __name__ = 'product.cost.plan.cost_date.context'
+
+    cost_date = fields.Date('Cost Date',
+        help="Price the operations with the work center rates effective at "
+        "this date.\n"
+        "Leave empty to use the current rates.")
+
+
+class OperationsCostCurveContext(CostDateContext):
+    'Operations Cost Curve Context'
+    __name__ = 'product.cost.plan.operations_cost_curve.context'
+
+    quantity_from = fields.Integer('From Quantity', required=True,
+        domain=[('quantity_from', '>', 0)])
+    quantity_to = fields.Integer('To Quantity', required=True,
+        domain=[('quantity_to', '>=', Eval('quantity_from', 0))])
+    quantity_step = fields.Integer('Step', required=True,
+        domain=[('quantity_step', '>', 0)])
+
+    @staticmethod
+    def default_quantity_from():
+        return 1
+
+    @staticmethod
+    def default_quantity_to():
+        return 100
+
+    @staticmethod
+    def default_quantity_step():
+        return 1
+
+
+class OperationsCostCurve(ModelSQL, ModelView):
+    'Operations Cost Curve'
+    __name__ = 'product.cost.plan.operations_cost_curve'
+
+    plan = fields.Many2One('product.cost.plan', 'Plan', readonly=True)
+    quantity = fields.Integer('Quantity', readonly=True)
+    unit_cost = fields.Function(fields.Numeric('Unit Operation Costs',
+            digits=DIGITS),
+        'get_unit_cost')
+
+    @classmethod
+    def __setup__(cls):
+        super(OperationsCostCurve, cls).__setup__()
+        cls._order.insert(0, ('quantity', 'ASC'))
+
+    @classmethod
+    def _get_quantities(cls):
+        'Return the first quantity, the step and the number of quantities'
+        context = Transaction().context
+        start = max(context.get('quantity_from') or 1, 1)
+        stop = max(context.get('quantity_to') or 100, start)
+        step = max(context.get('quantity_step') or 1, 1)
+        count = min((stop - start) // step + 1, CURVE_SIZE)
+        return start, step, count
+
+    @classmethod
+    def table_query(cls):
+        pool = Pool()
+        Plan = pool.get('product.cost.plan')
+        plan = Plan.__table__()
+        start, step, count = cls._get_quantities()
+
+        quantities = With('quantity', recursive=True)
+        quantities.query = Union(
+            Select([Literal(start)]),
+            quantities.select(quantities.quantity + step,
+                where=quantities.quantity + step
+                < start + step * count),
+            all_=True)
+        return plan.join(quantities, 'CROSS').select(
+            (plan.id * count + (quantities.quantity - start) / step
+                ).as_('id'),
+            Literal(0).as_('create_uid'),
+            CurrentTimestamp().as_('create_date'),
+            Literal(None).as_('write_uid'),
+            Literal(None).as_('write_date'),
+            plan.id.as_('plan'),
+            quantities.quantity.as_('quantity'),
+            with_=[quantities])
+
+    @classmethod
+    def get_unit_cost(cls, points, name):
+        pool = Pool()
+        Plan = pool.get('product.cost.plan')
+        plan2quantities = defaultdict(set)
+        for point in points:
+            plan2quantities[point.plan].add(point.quantity)
+        quantities = sorted(set().union(*plan2quantities.values()))
+        curves = Plan.get_operations_cost_curve(
+            list(plan2quantities), quantities)
+        costs = {(p, q): c for p, curve in curves.items()
+            for q, c in zip(quantities, curve)}
+        return {p.id: costs[p.plan.id, p.quantity] for p in points}
 
 
 class CreateRouteStart(ModelView):
     'Create Route Start'
     __name__ = 'product.cost.plan.create_route.start'
 
-    name = fields.Char('Name', required=True)
+    multiple = fields.Boolean('Multiple', readonly=True)
+    name = fields.Char('Name',
+        states={
+            'required': ~Eval('multiple', False),
+            'invisible': Eval('multiple', False),
+            })
+    reuse = fields.Boolean('Reuse Existing Route',
+        help='Link an existing route with the same operations instead of '
+        'creating a new one.')
+
+    @staticmethod
+    def default_reuse():
+        return REUSE_ROUTE
 
 
 class CreateRoute(Wizard):
@@ -329,18 +1852,26 @@ class CreateRoute(Wizard):
     route = StateAction('production_route.act_production_route')
 
     def default_start(self, fields):
-        CostPlan = Pool().get('product.cost.plan')
-        plan = CostPlan(Transaction().context.get('active_id'))
+        if len(self.records) == 1:
+            record, = self.records
+            return {
+                'multiple': False,
+                'name': record.rec_name,
+                }
         return {
-            'name': plan.rec_name,
+            'multiple': True,
             }
 
     def do_route(self, action):
         CostPlan = Pool().get('product.cost.plan')
-        plan = CostPlan(Transaction().context.get('active_id'))
-        route = plan.create_route(self.start.name)
+        names = None
+        if not self.start.multiple:
+            names = [self.start.name]
+        routes = CostPlan.create_routes(self.records, names,
+            reuse=self.start.reuse)
         data = {
-            'res_id': [route.id],
+            'res_id': list({r.id: None for r in routes}),
             }
-        action['views'].reverse()
+        if len(routes) == 1:
+            action['views'].reverse()
         return action, data
@@ -0,0 +1,54 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'''
+Opt-in timing of the cost plan pipeline.
+
+It is enabled with the profile option of the product_cost_plan_operation
+section of the configuration. Each measured call logs a structured line on
+the logger of this module with the cumulated call count of the process, the
+wall time and the rows read and written.
+'''
+from collections import defaultdict
+from contextlib import contextmanager
+import logging
+import time
+
+from trytond.config import config
+
+__all__ = ['measure']
+
+PROFILE = config.getboolean(
+    'product_cost_plan_operation', 'profile', default=False)
+
+logger = logging.getLogger(__name__)
+_calls = defaultdict(int)
+
+
+class _Stats(object):
+    __slots__ = ('rows_read', 'rows_written')
+
+    def __init__(self):
+        self.rows_read = 0
+        self.rows_written = 0
+
+
+@contextmanager
+def measure(name):
+    '''
+    Measure the block as name and yield the stats on which the block counts
+    the rows read and written
+    '''
+    stats = _Stats()
+    if not PROFILE:
+        yield stats
+        return
+    start = time.perf_counter()
+    try:
+        yield stats
+    finally:
+        duration = time.perf_counter() - start
+        _calls[name] += 1
+        logger.info(
+            "name=%s calls=%s duration=%.6f rows_read=%s rows_written=%s",
+            name, _calls[name], duration, stats.rows_read,
+            stats.rows_written)
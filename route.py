@@ -0,0 +1,197 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from collections import defaultdict
+import hashlib
+import json
+from weakref import WeakKeyDictionary
+
+from trytond.model import Index, fields
+from trytond.pool import Pool, PoolMeta
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
+
+from .plan import SYNC_ROUTE
+
+__all__ = ['Route', 'RouteOperation']
+
+# Snapshots of the route operations by transaction
+_operation_snapshots = WeakKeyDictionary()
+
+
+class Route(metaclass=PoolMeta):
+    __name__ = 'production.route'
+
+    fingerprint = fields.Char('Fingerprint', readonly=True,
+        help='Hash of the operations used to reuse identical routes.')
+
+    @classmethod
+    def __setup__(cls):
+        super(Route, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t,
+                (t.fingerprint, Index.Equality()),
+                (t.uom, Index.Equality())))
+
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().connection.cursor()
+        table_h = cls.__table_handler__(module_name)
+        table = cls.__table__()
+        fingerprint_exist = table_h.column_exist('fingerprint')
+
+        super(Route, cls).__register__(module_name)
+
+        if not fingerprint_exist:
+            cursor.execute(*table.select(table.id))
+            cls.update_fingerprint(cls.browse([i for i, in cursor]))
+
+    @classmethod
+    def _get_fingerprint_fields(cls):
+        'Return the operation fields that identify a route'
+        return ['sequence', 'operation_type', 'work_center_category',
+            'work_center', 'calculation', 'time', 'time_uom', 'quantity',
+            'quantity_uom', 'notes']
+
+    @classmethod
+    def get_fingerprint(cls, operations):
+        '''
+        Return the canonical hash of the operations given as a list of
+        dictionaries of values in sequence order
+        '''
+        def normalize(value):
+            if isinstance(value, float):
+                return repr(value)
+            return value
+
+        names = cls._get_fingerprint_fields()
+        operations = sorted(operations, key=lambda o: (
+                o.get('sequence') is None, o.get('sequence') or 0))
+        key = [[normalize(o.get(n)) for n in names] for o in operations]
+        return hashlib.sha256(
+            json.dumps(key, default=str).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def update_fingerprint(cls, routes):
+        '''
+        Store the fingerprint of the operations of routes.
+        Only the changed fingerprints are written, with one update by
+        fingerprint.
+        '''
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        names = cls._get_fingerprint_fields()
+
+        route_ids = [r.id for r in routes]
+        snapshots = cls.get_operation_snapshots(route_ids, names)
+        fingerprints = {}
+        for sub_ids in grouped_slice(route_ids):
+            cursor.execute(*table.select(table.id, table.fingerprint,
+                    where=reduce_ids(table.id, sub_ids)))
+            fingerprints.update(cursor)
+        to_update = defaultdict(list)
+        for route_id in route_ids:
+            fingerprint = cls.get_fingerprint(
+                [dict(zip(names, o)) for o in snapshots[route_id]])
+            if fingerprints.get(route_id) != fingerprint:
+                to_update[fingerprint].append(route_id)
+        for fingerprint, ids in to_update.items():
+            for sub_ids in grouped_slice(ids):
+                cursor.execute(*table.update(
+                        [table.fingerprint], [fingerprint],
+                        where=reduce_ids(table.id, sub_ids)))
+
+    @classmethod
+    def get_operation_snapshots(cls, route_ids, names):
+        '''
+        Return for each route id the tuple of its operations in sequence order
+        where each operation is the tuple of the values of the fields names.
+        The snapshots are kept for the transaction.
+        '''
+        pool = Pool()
+        Operation = pool.get('production.route.operation')
+        operation = Operation.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        names = tuple(names)
+        cache = _operation_snapshots.setdefault(transaction, {})
+
+        missing = [r for r in route_ids if (r, names) not in cache]
+        for sub_ids in grouped_slice(missing):
+            sub_ids = list(sub_ids)
+            operations = defaultdict(list)
+            cursor.execute(*operation.select(operation.route,
+                    *[getattr(operation, n) for n in names],
+                    where=reduce_ids(operation.route, sub_ids),
+                    order_by=[operation.route, operation.sequence.asc,
+                        operation.id]))
+            for row in cursor:
+                operations[row[0]].append(tuple(row[1:]))
+            for route_id in sub_ids:
+                cache[(route_id, names)] = tuple(operations[route_id])
+        return {r: cache[(r, names)] for r in route_ids}
+
+    @classmethod
+    def clear_operation_snapshots(cls, routes):
+        'Drop the cached operation snapshots of routes'
+        cache = _operation_snapshots.get(Transaction())
+        if cache:
+            route_ids = {r.id for r in routes}
+            for key in [k for k in cache if k[0] in route_ids]:
+                del cache[key]
+
+    @classmethod
+    def operations_changed(cls, routes):
+        '''
+        Refresh what depends on the operations of routes: their fingerprint
+        and, with the sync_route option, the cost plans using them
+        '''
+        pool = Pool()
+        Plan = pool.get('product.cost.plan')
+        cls.clear_operation_snapshots(routes)
+        routes = [r for r in routes
+            if r.id not in Transaction().delete_records.get(cls.__name__, ())]
+        cls.update_fingerprint(routes)
+        if SYNC_ROUTE:
+            Plan.sync_route(Plan.browse(Plan.get_route_plan_ids(routes)))
+
+    @classmethod
+    def on_modification(cls, mode, routes, field_names=None):
+        super().on_modification(mode, routes, field_names=field_names)
+        if mode == 'create':
+            # The routes created with operations are fingerprinted by them
+            cls.update_fingerprint([r for r in routes if not r.fingerprint])
+        else:
+            cls.clear_operation_snapshots(routes)
+
+
+class RouteOperation(metaclass=PoolMeta):
+    __name__ = 'production.route.operation'
+
+    @classmethod
+    def on_modification(cls, mode, operations, field_names=None):
+        pool = Pool()
+        Route = pool.get('production.route')
+        super().on_modification(mode, operations, field_names=field_names)
+        if mode in {'create', 'write'}:
+            Route.operations_changed(list({o.route for o in operations}))
+
+    @classmethod
+    def on_write(cls, operations, values):
+        pool = Pool()
+        Route = pool.get('production.route')
+        callback = super().on_write(operations, values)
+        if 'route' in values:
+            routes = list({o.route for o in operations})
+            callback.append(lambda: Route.operations_changed(routes))
+        return callback
+
+    @classmethod
+    def on_delete(cls, operations):
+        pool = Pool()
+        Route = pool.get('production.route')
+        callback = super().on_delete(operations)
+        routes = list({o.route for o in operations})
+        if routes:
+            callback.append(lambda: Route.operations_changed(routes))
+        return callback
@@ -0,0 +1,216 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'''
+Benchmarks of the product_cost_plan_operation hot paths.
+
+Synthetic routes, work center categories and cost plans are generated at the
+requested scale in the test database configured by TRYTOND_DATABASE_URI and
+DB_NAME, everything is rolled back at the end. Run them with:
+
+    python -m trytond.modules.product_cost_plan_operation.tests.benchmark \
+        --plans 10000 --operations 20 --output results.json
+
+The JSON results can be compared between releases to spot regressions.
+'''
+import argparse
+import json
+import sys
+import time
+import timeit
+from decimal import Decimal
+
+from trytond.modules.company.tests import create_company, set_company
+from trytond.pool import Pool
+from trytond.tests.test_tryton import activate_module, with_transaction
+
+from .. import engine
+from ..uom import compute_qty
+
+MODULE = 'product_cost_plan_operation'
+
+
+def _timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def _create_data(options):
+    'Create the synthetic routes and cost plans'
+    pool = Pool()
+    ModelData = pool.get('ir.model.data')
+    Category = pool.get('production.work_center.category')
+    OperationType = pool.get('production.operation.type')
+    Route = pool.get('production.route')
+    Template = pool.get('product.template')
+    Plan = pool.get('product.cost.plan')
+
+    hour = ModelData.get_id('product', 'uom_hour')
+    minute = ModelData.get_id('product', 'uom_minute')
+    unit = ModelData.get_id('product', 'uom_unit')
+
+    categories = Category.create([{
+                'name': 'Category %s' % i,
+                'uom': hour,
+                'cost_price': Decimal(10 + i),
+                } for i in range(options.categories)])
+    operation_type, = OperationType.create([{'name': 'Benchmark'}])
+    routes = Route.create([{
+                'name': 'Route %s' % r,
+                'uom': unit,
+                'operations': [('create', [{
+                                'sequence': o,
+                                'operation_type': operation_type.id,
+                                'work_center_category': categories[
+                                    (r + o) % len(categories)].id,
+                                'calculation': (
+                                    'fixed' if o % 5 == 0 else 'standard'),
+                                'time': 1 + o % 7,
+                                'time_uom': minute if o % 2 else hour,
+                                'quantity': 1 + o % 3,
+                                'quantity_uom': unit,
+                                } for o in range(options.operations)])],
+                } for r in range(options.routes)])
+    template, = Template.create([{
+                'name': 'Benchmark Product',
+                'type': 'goods',
+                'producible': True,
+                'default_uom': unit,
+                'list_price': Decimal(30),
+                'products': [('create', [{}])],
+                }])
+    product, = template.products
+    return Plan.create([{
+                'product': product.id,
+                'route': routes[p % len(routes)].id,
+                'uom': unit,
+                'quantity': 1 + p % 50,
+                'production_quantity': 10,
+                } for p in range(options.plans)])
+
+
+@with_transaction()
+def benchmark_plan(options):
+    'Time the cost plan pipeline on synthetic data'
+    pool = Pool()
+    Plan = pool.get('product.cost.plan')
+    OperationLine = pool.get('product.cost.plan.operation_line')
+
+    company = create_company()
+    with set_company(company):
+        start = time.perf_counter()
+        plans = _create_data(options)
+        result = {
+            'plans': options.plans,
+            'operations': options.operations,
+            'routes': options.routes,
+            'categories': options.categories,
+            'setup': time.perf_counter() - start,
+            }
+
+        result['compute'] = _timed(Plan.compute, plans)
+        lines = OperationLine.search([('plan', 'in', [p.id for p in plans])])
+        result['lines'] = len(lines)
+        result['read_line_costs'] = _timed(OperationLine.read,
+            [l.id for l in lines], ['unit_cost', 'total_cost'])
+        result['operations_cost'] = _timed(Plan.read,
+            [p.id for p in plans], ['operations_cost'])
+        to_copy = plans[:options.copies]
+        result['copies'] = len(to_copy)
+        result['copy'] = _timed(Plan.copy, to_copy)
+        result['clean'] = _timed(Plan.clean, plans)
+    return result
+
+
+@with_transaction()
+def benchmark_uom(options):
+    'Time the UoM conversions of one operation line'
+    pool = Pool()
+    Uom = pool.get('product.uom')
+    ModelData = pool.get('ir.model.data')
+    minute = Uom(ModelData.get_id('product', 'uom_minute'))
+    hour = Uom(ModelData.get_id('product', 'uom_hour'))
+    unit = Uom(ModelData.get_id('product', 'uom_unit'))
+
+    def generic():
+        Uom.compute_qty(minute, 30.0, hour, round=False)
+        Uom.compute_qty(unit, 3.0, unit, round=False)
+
+    def cached():
+        compute_qty(minute, 30.0, hour)
+        compute_qty(unit, 3.0, unit)
+
+    generic_time = min(timeit.repeat(generic, number=options.number,
+            repeat=3))
+    cached_time = min(timeit.repeat(cached, number=options.number, repeat=3))
+    return {
+        'lines': options.number,
+        'generic': generic_time,
+        'cached': cached_time,
+        'speedup': generic_time / cached_time if cached_time else None,
+        }
+
+
+def benchmark_engine(options):
+    'Time the cost engine on synthetic arrays'
+    plans = engine.Plans()
+    operations = engine.Operations()
+    for i in range(options.plans):
+        plans.add(i, 1 + i % 50, 10)
+    for i in range(options.plans * options.operations):
+        operations.add(i, i % options.plans,
+            'fixed' if i % 5 == 0 else 'standard', 1 + i % 3,
+            Decimal(10 + i % 7))
+
+    duration = min(timeit.repeat(
+            lambda: engine.total_costs(plans, operations), number=1,
+            repeat=3))
+    return {
+        'lines': len(operations),
+        'total_costs': duration,
+        'lines_per_second': len(operations) / duration if duration else None,
+        }
+
+
+BENCHMARKS = {
+    'plan': benchmark_plan,
+    'uom': benchmark_uom,
+    'engine': benchmark_engine,
+    }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+        help='the benchmarks to run among %s (default: all)'
+        % ', '.join(BENCHMARKS))
+    parser.add_argument('--plans', type=int, default=100,
+        help='the number of cost plans')
+    parser.add_argument('--operations', type=int, default=20,
+        help='the number of operations per route')
+    parser.add_argument('--routes', type=int, default=10,
+        help='the number of routes shared by the plans')
+    parser.add_argument('--categories', type=int, default=5,
+        help='the number of work center categories')
+    parser.add_argument('--copies', type=int, default=100,
+        help='the number of plans to copy')
+    parser.add_argument('-n', '--number', type=int, default=10000,
+        help='the number of iterations of the micro-benchmarks')
+    parser.add_argument('-o', '--output', type=argparse.FileType('w'),
+        default=sys.stdout, help='the JSON file to write the results to')
+    options = parser.parse_args(args)
+    for name in options.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark: %s' % name)
+
+    activate_module(MODULE)
+    results = {}
+    for name in options.benchmarks or BENCHMARKS:
+        results[name] = BENCHMARKS[name](options)
+    json.dump(results, options.output, indent=2)
+    options.output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -2,13 +2,760 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 
-from trytond.modules.company.tests import CompanyTestMixin
-from trytond.tests.test_tryton import ModuleTestCase
+import csv
+import datetime as dt
+import os
+import tempfile
+import unittest
+from decimal import Decimal
+from unittest.mock import call, patch
+
+try:
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from trytond.exceptions import UserWarning
+from trytond.modules.company.tests import (
+    CompanyTestMixin, create_company, set_company)
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+
+from .. import engine
+from .. import plan as plan_module
+from ..uom import compute_qty
+
+
+def create_category(cost_price, name='Category'):
+    'Create a work center category priced by hour'
+    pool = Pool()
+    ModelData = pool.get('ir.model.data')
+    Category = pool.get('production.work_center.category')
+    category, = Category.create([{
+                'name': name,
+                'uom': ModelData.get_id('product', 'uom_hour'),
+                'cost_price': cost_price,
+                }])
+    return category
+
+
+def create_product(name='Product'):
+    'Create a producible product in units'
+    pool = Pool()
+    ModelData = pool.get('ir.model.data')
+    Template = pool.get('product.template')
+    template, = Template.create([{
+                'name': name,
+                'type': 'goods',
+                'producible': True,
+                'default_uom': ModelData.get_id('product', 'uom_unit'),
+                'list_price': Decimal(30),
+                'products': [('create', [{}])],
+                }])
+    product, = template.products
+    return product
+
+
+def operation_values(category, time, calculation='standard', quantity=1,
+        sequence=None, time_uom=None, **values):
+    'Return the values of an operation line or a route operation'
+    pool = Pool()
+    ModelData = pool.get('ir.model.data')
+    values.update({
+            'sequence': sequence,
+            'work_center_category': category.id,
+            'calculation': calculation,
+            'time': time,
+            'time_uom': (time_uom.id if time_uom
+                else ModelData.get_id('product', 'uom_hour')),
+            })
+    if calculation == 'standard':
+        values['quantity'] = quantity
+        values['quantity_uom'] = ModelData.get_id('product', 'uom_unit')
+    return values
+
+
+def create_route(operations, name='Route'):
+    'Create a route in units with the operations values'
+    pool = Pool()
+    ModelData = pool.get('ir.model.data')
+    Route = pool.get('production.route')
+    route, = Route.create([{
+                'name': name,
+                'uom': ModelData.get_id('product', 'uom_unit'),
+                'operations': [('create', operations)],
+                }])
+    return route
+
+
+def create_plan(product, operations, quantity=7, production_quantity=4,
+        route=None):
+    'Create a cost plan of product with the operation lines values'
+    pool = Pool()
+    ModelData = pool.get('ir.model.data')
+    Plan = pool.get('product.cost.plan')
+    plan, = Plan.create([{
+                'product': product.id,
+                'route': route.id if route else None,
+                'uom': ModelData.get_id('product', 'uom_unit'),
+                'quantity': quantity,
+                'production_quantity': production_quantity,
+                'operations': [('create', operations)],
+                }])
+    return plan
 
 
 class ProductCostPlanOperationTestCase(CompanyTestMixin, ModuleTestCase):
     'Test ProductCostPlanOperation module'
     module = 'product_cost_plan_operation'
 
+    @with_transaction()
+    def test_uom_compute_qty(self):
+        'Test cached UoM conversion matches compute_qty'
+        pool = Pool()
+        Uom = pool.get('product.uom')
+
+        uoms = Uom.search([])
+        for from_uom in uoms:
+            for to_uom in uoms:
+                if from_uom.category != to_uom.category:
+                    continue
+                for qty in [0, 1, 2.5, 30, 1 / 3]:
+                    self.assertEqual(
+                        compute_qty(from_uom, qty, to_uom),
+                        Uom.compute_qty(from_uom, qty, to_uom, round=False))
+
+    def _check_cost_search_order(self, plans):
+        'Check searching and ordering the costs of plans match the getters'
+        pool = Pool()
+        OperationLine = pool.get('product.cost.plan.operation_line')
+        Plan = pool.get('product.cost.plan')
+
+        domain = [('plan', 'in', [p.id for p in plans])]
+        lines = OperationLine.search(domain)
+        costs = OperationLine.read([l.id for l in lines],
+            ['unit_cost', 'total_cost'])
+        for name in ['unit_cost', 'total_cost']:
+            for threshold in [0, Decimal('1.0417'), 10, '25', 1000]:
+                self.assertEqual(
+                    {l.id for l in OperationLine.search(
+                            domain + [(name, '>', threshold)])},
+                    {c['id'] for c in costs
+                        if c[name] > Decimal(threshold)})
+            self.assertEqual(
+                [l.id for l in OperationLine.search(
+                        domain, order=[(name, 'ASC'), ('id', 'ASC')])],
+                [c['id'] for c in sorted(costs,
+                        key=lambda c: (c[name], c['id']))])
+
+        domain = [('id', 'in', [p.id for p in plans])]
+        costs = Plan.read([p.id for p in plans], ['operations_cost'])
+        for threshold in [0, 10, 100]:
+            self.assertEqual(
+                {p.id for p in Plan.search(
+                        domain + [('operations_cost', '>', threshold)])},
+                {c['id'] for c in costs
+                    if c['operations_cost'] > threshold})
+        self.assertEqual(
+            [p.id for p in Plan.search(domain,
+                    order=[('operations_cost', 'ASC'), ('id', 'ASC')])],
+            [c['id'] for c in sorted(costs,
+                    key=lambda c: (c['operations_cost'], c['id']))])
+
+    def _create_search_plan(self, category, **values):
+        return create_plan(create_product(), [
+                operation_values(category, 1.5, quantity=1),
+                operation_values(category, 2, quantity=2),
+                operation_values(category, 0.25, quantity=3),
+                operation_values(category, 1, calculation='fixed'),
+                operation_values(category, 0, quantity=1),
+                ], **values)
+
+    @with_transaction()
+    def test_cost_search_order(self):
+        'Test searching and ordering costs match the getters'
+        company = create_company()
+        with set_company(company):
+            category = create_category(Decimal('12.5'))
+            plan = self._create_search_plan(category)
+            self._check_cost_search_order([plan])
+
+    @with_transaction()
+    def test_cost_search_order_zero_production_quantity(self):
+        'Test searching and ordering costs without production quantity'
+        company = create_company()
+        with set_company(company):
+            category = create_category(Decimal('12.5'))
+            plans = [self._create_search_plan(category),
+                self._create_search_plan(category, production_quantity=0)]
+            self._check_cost_search_order(plans)
+
+    @with_transaction()
+    def test_dated_cost_rates(self):
+        'Test the costs at a date use the rates effective at that date'
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        Category = pool.get('production.work_center.category')
+        Rate = pool.get('production.work_center.category.rate')
+        WorkCenter = pool.get('production.work_center')
+        OperationLine = pool.get('product.cost.plan.operation_line')
+        Plan = pool.get('product.cost.plan')
+
+        company = create_company()
+        with set_company(company):
+            category = create_category(Decimal(10))
+            Rate.create([{
+                        'category': category.id,
+                        'effective_date': dt.date(2000, 1, 1),
+                        'cost_price': Decimal(20),
+                        }, {
+                        'category': category.id,
+                        'effective_date': dt.date(2100, 1, 1),
+                        'cost_price': Decimal(30),
+                        }])
+            # The cost price is the rate effective today
+            self.assertEqual(Category(category.id).cost_price, Decimal(20))
+
+            work_center, = WorkCenter.create([{
+                        'name': 'Work Center',
+                        'type': 'machine',
+                        'category': category.id,
+                        'uom': ModelData.get_id('product', 'uom_hour'),
+                        'cost_price': Decimal(50),
+                        }])
+            plan = create_plan(create_product(), [
+                    operation_values(category, 1),
+                    operation_values(category, 1,
+                        work_center=work_center.id),
+                    ], quantity=1)
+            category_line, work_center_line = plan.operations
+
+            for date, cost_price in [
+                    (None, Decimal(20)),
+                    (dt.date(2100, 6, 1), Decimal(30)),
+                    # Before the first rate
+                    (dt.date(1999, 1, 1), Decimal(20)),
+                    ]:
+                with Transaction().set_context(cost_date=date):
+                    lines = OperationLine.browse(
+                        [category_line.id, work_center_line.id])
+                    self.assertEqual(
+                        OperationLine.get_cost(lines, ['total_cost']),
+                        {'total_cost': {
+                                category_line.id: cost_price,
+                                work_center_line.id: Decimal(50),
+                                }})
+                    self.assertEqual(
+                        [l.get_total_cost() for l in lines],
+                        [cost_price, Decimal(50)])
+                    plan = Plan(plan.id)
+                    self.assertEqual(plan.operations_cost,
+                        cost_price + Decimal(50))
+
+    @with_transaction()
+    def test_dated_cost_search_order(self):
+        'Test searching and ordering the costs at a date'
+        pool = Pool()
+        Rate = pool.get('production.work_center.category.rate')
+
+        company = create_company()
+        with set_company(company):
+            category = create_category(Decimal(10))
+            # The dated costs do not depend on the current cost price
+            future = create_category(Decimal(0), name='Future')
+            Rate.create([{
+                        'category': category.id,
+                        'effective_date': dt.date(2000, 1, 1),
+                        'cost_price': Decimal(20),
+                        }, {
+                        'category': category.id,
+                        'effective_date': dt.date(2100, 1, 1),
+                        'cost_price': Decimal(30),
+                        }, {
+                        'category': future.id,
+                        'effective_date': dt.date(2100, 1, 1),
+                        'cost_price': Decimal(40),
+                        }])
+            plans = [
+                self._create_search_plan(category),
+                self._create_search_plan(future),
+                self._create_search_plan(category, production_quantity=0),
+                ]
+            for date in [None, dt.date(2100, 6, 1), dt.date(1999, 1, 1)]:
+                with Transaction().set_context(cost_date=date):
+                    self._check_cost_search_order(plans)
+
+    @with_transaction()
+    def test_outdated_cost_rates(self):
+        'Test the refresh of the costs outdated by a rate change'
+        pool = Pool()
+        Category = pool.get('production.work_center.category')
+        OperationLine = pool.get('product.cost.plan.operation_line')
+        Plan = pool.get('product.cost.plan')
+
+        company = create_company()
+        with set_company(company):
+            category = create_category(Decimal(10))
+            plan = create_plan(create_product(), [
+                    operation_values(category, 1),
+                    ], quantity=1)
+            line, = plan.operations
+            domain = [('id', '=', line.id)]
+
+            with patch.object(Plan, 'queue_refresh_operations_cost',
+                    wraps=Plan.queue_refresh_operations_cost) as queue:
+                Category.write([category], {'cost_price': Decimal(20)})
+                Category.write([category], {'cost_price': Decimal(30)})
+            # The refresh of the plan is pending after the first change
+            self.assertEqual(queue.call_args_list,
+                [call([plan]), call([])])
+
+            line = OperationLine(line.id)
+            self.assertTrue(line.cost_rates_outdated)
+            self.assertEqual(line.total_cost, Decimal(30))
+            # The SQL search uses the stored cost until it is refreshed
+            self.assertEqual(OperationLine.search(
+                    domain + [('total_cost', '=', 10)]), [line])
+            self.assertEqual(OperationLine.search(
+                    domain + [('total_cost', '=', 30)]), [])
+
+            Plan.refresh_operations_cost([plan])
+            line = OperationLine(line.id)
+            self.assertFalse(line.cost_rates_outdated)
+            self.assertEqual(OperationLine.search(
+                    domain + [('total_cost', '=', 30)]), [line])
+            self.assertEqual(Plan(plan.id).operations_cost, Decimal(30))
+
+            # The following tasks find nothing outdated
+            with patch.object(OperationLine, 'update_cost_rates',
+                    wraps=OperationLine.update_cost_rates) as update:
+                Plan.refresh_operations_cost([plan])
+            self.assertEqual(update.call_count, 0)
+
+    @with_transaction()
+    def test_uom_outdated_cost_rates(self):
+        'Test changing a UoM factor outdates the costs converted with it'
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        Uom = pool.get('product.uom')
+        OperationLine = pool.get('product.cost.plan.operation_line')
+        Plan = pool.get('product.cost.plan')
+
+        company = create_company()
+        with set_company(company):
+            hour = Uom(ModelData.get_id('product', 'uom_hour'))
+            shift, = Uom.create([{
+                        'name': 'Shift',
+                        'symbol': 'shift',
+                        'category': hour.category.id,
+                        'factor': hour.factor * 8,
+                        'rate': 1 / (hour.factor * 8),
+                        }])
+            category = create_category(Decimal(10))
+            plan = create_plan(create_product(), [
+                    operation_values(category, 1, time_uom=shift),
+                    operation_values(category, 1),
+                    ], quantity=1)
+            shift_line, hour_line = OperationLine.search(
+                [('plan', '=', plan.id)], order=[('id', 'ASC')])
+            self.assertEqual(shift_line.total_cost, Decimal(80))
+
+            Uom.write([shift], {
+                    'factor': hour.factor * 4,
+                    'rate': 1 / (hour.factor * 4),
+                    })
+            shift_line, hour_line = OperationLine.browse(
+                [shift_line.id, hour_line.id])
+            self.assertTrue(shift_line.cost_rates_outdated)
+            self.assertFalse(hour_line.cost_rates_outdated)
+            self.assertEqual(shift_line.total_cost, Decimal(40))
+            self.assertEqual(Plan(plan.id).operations_cost, Decimal(50))
+
+            Plan.refresh_operations_cost([plan])
+            self.assertEqual(OperationLine.search([
+                        ('plan', '=', plan.id),
+                        ('total_cost', '=', 40),
+                        ]), [shift_line])
+
+    @with_transaction()
+    def test_operations_cost_cache(self):
+        'Test the stored operations cost follows the changes'
+        pool = Pool()
+        Category = pool.get('production.work_center.category')
+        OperationLine = pool.get('product.cost.plan.operation_line')
+        Plan = pool.get('product.cost.plan')
+        table = Plan.__table__()
+        cursor = Transaction().connection.cursor()
+
+        def cache():
+            cursor.execute(*table.select(table.operations_cost_cache,
+                    where=table.id == plan.id))
+            cost, = cursor.fetchone()
+            return Decimal(str(cost)) if cost is not None else None
+
+        def cost():
+            cost, = Plan.read([plan.id], ['operations_cost'])
+            return cost['operations_cost']
+
+        company = create_company()
+        with set_company(company), \
+                patch.object(plan_module, 'OPERATIONS_COST_CACHE', True):
+            category = create_category(Decimal(10))
+            plan = create_plan(create_product(), [
+                    operation_values(category, 1),
+                    operation_values(category, 1, calculation='fixed'),
+                    ], quantity=1, production_quantity=4)
+            self.assertEqual(cache(), Decimal(20))
+
+            line, = OperationLine.create([
+                    operation_values(category, 2, plan=plan.id)])
+            self.assertEqual(cache(), Decimal(40))
+            OperationLine.write([line], {'time': 3})
+            self.assertEqual(cache(), Decimal(50))
+            OperationLine.delete([line])
+            self.assertEqual(cache(), Decimal(20))
+
+            Plan.write([plan], {'quantity': 2})
+            self.assertEqual(cache(), Decimal(15))
+
+            Category.write([category], {'cost_price': Decimal(20)})
+            self.assertEqual(cache(), None)
+            self.assertEqual(cost(), Decimal(30))
+            Plan.refresh_operations_cost([plan])
+            self.assertEqual(cache(), Decimal(30))
+
+            with patch.object(plan_module, 'OPERATIONS_COST_CACHE', False):
+                line, = OperationLine.create([
+                        operation_values(category, 1, plan=plan.id)])
+                self.assertEqual(cache(), None)
+                self.assertEqual(cost(), Decimal(50))
+            # No stale cost is read once the cache is enabled again
+            self.assertEqual(cost(), Decimal(50))
+            OperationLine.write([line], {'time': 2})
+            self.assertEqual(cache(), Decimal(70))
+
+            Plan.clean([plan])
+            self.assertEqual(cache(), Decimal(0))
+            self.assertEqual(cost(), Decimal(0))
+
+    @with_transaction()
+    def test_copy(self):
+        'Test copying plans copies the lines of each plan into its copy'
+        pool = Pool()
+        OperationLine = pool.get('product.cost.plan.operation_line')
+        Plan = pool.get('product.cost.plan')
+
+        def times(plan):
+            return sorted(l.time for l in OperationLine.search([
+                        ('plan', '=', plan.id),
+                        ]))
+
+        company = create_company()
+        with set_company(company):
+            category = create_category(Decimal(10))
+            plans = [
+                create_plan(create_product(), [
+                        operation_values(category, 1),
+                        operation_values(category, 2),
+                        ]),
+                create_plan(create_product(), [
+                        operation_values(category, 3),
+                        ]),
+                create_plan(create_product(), []),
+                ]
+            new_plans = Plan.copy(plans)
+
+            self.assertEqual([times(p) for p in new_plans],
+                [[1, 2], [3], []])
+            self.assertEqual([times(p) for p in plans], [[1, 2], [3], []])
+            for plan, new_plan in zip(plans, new_plans):
+                self.assertEqual(Plan(new_plan.id).operations_cost,
+                    Plan(plan.id).operations_cost)
+
+    @with_transaction()
+    def test_simulate_operations_cost(self):
+        'Test simulating the operations cost without writing'
+        pool = Pool()
+        OperationLine = pool.get('product.cost.plan.operation_line')
+        Plan = pool.get('product.cost.plan')
+
+        company = create_company()
+        with set_company(company):
+            category = create_category(Decimal(10))
+            plan = create_plan(create_product(), [
+                    operation_values(category, 1),
+                    operation_values(category, 1, calculation='fixed'),
+                    ], quantity=7, production_quantity=4)
+            line, _ = OperationLine.search([('plan', '=', plan.id)],
+                order=[('id', 'ASC')])
+            current = Decimal('12.8571')
+
+            with patch.object(Plan, 'write') as plan_write, \
+                    patch.object(OperationLine, 'write') as line_write, \
+                    patch.object(OperationLine, 'update_cost_rates'
+                        ) as update_cost_rates:
+                for kwargs, simulated in [
+                        ({}, current),
+                        ({'cost_prices': {category.id: 20}},
+                            Decimal('25.7143')),
+                        ({'quantities': {plan.id: 8}}, Decimal('12.5')),
+                        ({'production_quantities': {plan.id: 7}},
+                            Decimal('11.4286')),
+                        ({'times': {line.id: 2}}, Decimal('22.8571')),
+                        ]:
+                    self.assertEqual(
+                        Plan.simulate_operations_cost([plan], **kwargs),
+                        {plan.id: (current, simulated, simulated - current)})
+            plan_write.assert_not_called()
+            line_write.assert_not_called()
+            update_cost_rates.assert_not_called()
+            self.assertEqual(Plan(plan.id).operations_cost, current)
+
+    def _create_export_lines(self):
+        'Create the lines exported and return them with their costs'
+        pool = Pool()
+        OperationLine = pool.get('product.cost.plan.operation_line')
+
+        category = create_category(Decimal('12.5'))
+        plan = create_plan(create_product(), [
+                operation_values(category, 1.5, quantity=1, name='Cut'),
+                operation_values(category, 2, quantity=2),
+                operation_values(category, 0.25, quantity=3),
+                operation_values(category, 1, calculation='fixed'),
+                ])
+        lines = OperationLine.search([('plan', '=', plan.id)],
+            order=[('id', 'ASC')])
+        return lines, OperationLine.get_cost(
+            lines, ['unit_cost', 'total_cost'])
+
+    @with_transaction()
+    def test_export_costs_csv(self):
+        'Test exporting the costs as CSV'
+        pool = Pool()
+        OperationLine = pool.get('product.cost.plan.operation_line')
+
+        company = create_company()
+        with set_company(company):
+            lines, costs = self._create_export_lines()
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, 'costs.csv')
+                count = OperationLine.export_costs(path, batch_size=3)
+                with open(path, newline='', encoding='utf-8') as file_:
+                    reader = csv.reader(file_)
+                    header = next(reader)
+                    rows = [dict(zip(header, r)) for r in reader]
+
+                # The batches stay within a domain starting with OR
+                or_path = os.path.join(directory, 'or.csv')
+                or_count = OperationLine.export_costs(or_path, domain=[
+                        'OR',
+                        ('name', '=', 'Cut'),
+                        ('calculation', '=', 'fixed'),
+                        ], batch_size=1)
+                with open(or_path, newline='', encoding='utf-8') as file_:
+                    or_ids = [int(r['id']) for r in csv.DictReader(file_)]
+
+        self.assertEqual(count, len(lines))
+        self.assertEqual(or_count, 2)
+        self.assertEqual(or_ids, [l.id for l in lines
+                if l.name == 'Cut' or l.calculation == 'fixed'])
+        self.assertEqual(header,
+            [n for n, _ in OperationLine._get_export_columns()])
+        self.assertEqual([int(r['id']) for r in rows], [l.id for l in lines])
+        for line, row in zip(lines, rows):
+            self.assertEqual(row['name'], line.name or '')
+            self.assertEqual(row['calculation'], line.calculation)
+            self.assertEqual(float(row['time']), line.time)
+            self.assertEqual(row['work_center'], '')
+            self.assertEqual(Decimal(row['unit_cost']),
+                costs['unit_cost'][line.id])
+            self.assertEqual(Decimal(row['total_cost']),
+                costs['total_cost'][line.id])
+
+    @unittest.skipIf(not pyarrow, "pyarrow is not installed")
+    @with_transaction()
+    def test_export_costs_parquet(self):
+        'Test exporting the costs as Parquet'
+        pool = Pool()
+        OperationLine = pool.get('product.cost.plan.operation_line')
+
+        company = create_company()
+        with set_company(company):
+            lines, costs = self._create_export_lines()
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, 'costs.parquet')
+                count = OperationLine.export_costs(path, format='parquet',
+                    batch_size=3)
+                table = pyarrow.parquet.read_table(path)
+
+        self.assertEqual(count, len(lines))
+        self.assertEqual(table.schema.names,
+            [n for n, _ in OperationLine._get_export_columns()])
+        rows = table.to_pylist()
+        self.assertEqual([r['id'] for r in rows], [l.id for l in lines])
+        for line, row in zip(lines, rows):
+            self.assertEqual(row['name'], line.name)
+            self.assertEqual(row['work_center'], None)
+            self.assertEqual(row['unit_cost'], costs['unit_cost'][line.id])
+            self.assertEqual(row['total_cost'], costs['total_cost'][line.id])
+
+    @with_transaction()
+    def test_sync_route(self):
+        'Test synchronizing the operation lines with the route'
+        pool = Pool()
+        OperationType = pool.get('production.operation.type')
+        Route = pool.get('production.route')
+        OperationLine = pool.get('product.cost.plan.operation_line')
+        Plan = pool.get('product.cost.plan')
+
+        company = create_company()
+        with set_company(company):
+            category = create_category(Decimal(10))
+            cut, drill, paint = OperationType.create([
+                    {'name': 'Cut'}, {'name': 'Drill'}, {'name': 'Paint'}])
+            route = create_route([
+                    operation_values(category, 1, sequence=1,
+                        operation_type=cut.id),
+                    operation_values(category, 2, sequence=2,
+                        operation_type=drill.id),
+                    operation_values(category, 3, sequence=3,
+                        operation_type=paint.id),
+                    ])
+            plan = create_plan(create_product(), [
+                    operation_values(category, 1, sequence=1,
+                        operation_type=cut.id, name='Kept'),
+                    operation_values(category, 2, sequence=2,
+                        operation_type=drill.id, name='Changed'),
+                    operation_values(category, 3, sequence=3,
+                        operation_type=paint.id, name='Lost'),
+                    ], route=route)
+            kept, changed, lost = OperationLine.search(
+                [('plan', '=', plan.id)], order=[('sequence', 'ASC')])
+
+            drill_operation, paint_operation = [o for o in route.operations
+                if o.sequence in {2, 3}]
+            Route.write([route], {
+                    'operations': [
+                        ('write', [drill_operation.id], {'time': 5}),
+                        ('delete', [paint_operation.id]),
+                        ('create', [operation_values(category, 4,
+                                    sequence=4, operation_type=cut.id)]),
+                        ],
+                    })
+
+            with patch.object(OperationLine, 'write',
+                    wraps=OperationLine.write) as write:
+                Plan.sync_route([Plan(plan.id)])
+
+            self.assertEqual(write.call_args_list,
+                [call([changed], {'time': 5})])
+            lines = OperationLine.search([('plan', '=', plan.id)],
+                order=[('sequence', 'ASC')])
+            self.assertEqual(
+                [(l.sequence, l.operation_type, l.time) for l in lines],
+                [(1, cut, 1), (2, drill, 5), (4, cut, 4)])
+            self.assertEqual(lines[:2], [kept, changed])
+            self.assertEqual([l.name for l in lines[:2]], ['Kept', 'Changed'])
+            self.assertFalse(OperationLine.search([('id', '=', lost.id)]))
+
+    @with_transaction()
+    def test_create_routes_reuse(self):
+        'Test creating routes for plans with identical operations'
+        pool = Pool()
+        OperationType = pool.get('production.operation.type')
+        Product = pool.get('product.product')
+        Route = pool.get('production.route')
+        Plan = pool.get('product.cost.plan')
+        Warning = pool.get('res.user.warning')
+
+        company = create_company()
+        with set_company(company):
+            category = create_category(Decimal(10))
+            cut, = OperationType.create([{'name': 'Cut'}])
+            plans = [create_plan(create_product(name), [
+                        operation_values(category, 1, sequence=1,
+                            operation_type=cut.id),
+                        operation_values(category, 2, sequence=2,
+                            operation_type=cut.id,
+                            calculation='fixed'),
+                        ]) for name in ['Product 1', 'Product 2']]
+
+            route, other = Plan.create_routes(plans, reuse=True)
+            self.assertEqual(route, other)
+            self.assertEqual(len(route.operations), 2)
+
+            plans = Plan.browse([p.id for p in plans])
+            with self.assertRaises(UserWarning) as cm:
+                Plan.create_routes(plans)
+            for plan in plans:
+                self.assertIn(plan.rec_name, cm.exception.message)
+
+            with patch.object(Warning, 'check', return_value=False) as check:
+                routes = Plan.create_routes(plans, reuse=False)
+            self.assertEqual(check.call_count, 1)
+            self.assertEqual(len(set(routes)), 2)
+            self.assertNotIn(route, routes)
+
+            for plan, route in zip(
+                    Plan.browse([p.id for p in plans]), routes):
+                self.assertEqual(plan.route, route)
+                product = Product(plan.product.id)
+                self.assertEqual(len(product.boms), 1)
+                self.assertEqual(product.boms[0].route, route)
+
+            # The fingerprints given at creation match the operations
+            names = Route._get_fingerprint_fields()
+            snapshots = Route.get_operation_snapshots(
+                [r.id for r in routes], names)
+            for route in Route.browse([r.id for r in routes]):
+                self.assertEqual(route.fingerprint, Route.get_fingerprint(
+                        [dict(zip(names, o)) for o in snapshots[route.id]]))
+
+
+class EngineTestCase(unittest.TestCase):
+    'Test the cost engine without a database'
+
+    def test_engine_costs(self):
+        'Test cost engine'
+        plans = engine.Plans()
+        operations = engine.Operations()
+        plan = plans.add(1, 10, 4)
+        empty = plans.add(2, 0, 1)
+        self.assertEqual(plans.add(1, 5, 5), plan)
+        operations.add(1, plan, 'standard', 2, Decimal('1.5'))
+        operations.add(2, plan, 'fixed', None, Decimal('3'))
+        operations.add(3, plan, 'standard', 0, Decimal('1'))
+        operations.add(4, plan, 'fixed', None, None)
+        operations.add(5, empty, 'fixed', None, Decimal('1'))
+
+        self.assertEqual(engine.total_costs(plans, operations), [
+                Decimal('7.5'), Decimal('9'), 0, 0, 0])
+        self.assertEqual(engine.line_costs(plans, operations, 2, 4), (
+                [Decimal('7.50'), Decimal('9.00'), 0, 0, 0],
+                [Decimal('0.7500'), Decimal('0.9000'), 0, 0, 0]))
+        self.assertEqual(engine.plan_costs(plans, operations, 4), [
+                Decimal('1.6500'), 0])
+        self.assertEqual(
+            engine.line_cost('fixed', 10, 4, None, Decimal('3')),
+            Decimal('9'))
+
+    def test_engine_cost_curves(self):
+        'Test cost engine curves match the plan costs'
+        operations = engine.Operations()
+        plans = engine.Plans()
+        plan = plans.add(1, 1, 4)
+        operations.add(1, plan, 'standard', 2, Decimal('1.5'))
+        operations.add(2, plan, 'standard', 3, Decimal('0.25'))
+        operations.add(3, plan, 'fixed', None, Decimal('3'))
+        operations.add(4, plan, 'standard', 2, None)
+
+        quantities = [0, 1, 3, 4, 5, 7.5, 100]
+        curve, = engine.cost_curves(plans, operations, quantities, 4)
+        for quantity, cost in zip(quantities, curve):
+            plans.quantities[plan] = quantity
+            self.assertEqual(
+                cost, engine.plan_costs(plans, operations, 4)[plan])
+
 
 del ModuleTestCase
@@ -182,7 +182,7 @@ class Test(unittest.TestCase):
         product_cost, operations_cost = plan.costs
         self.assertEqual(product_cost.cost, plan.products_cost)
         self.assertEqual(operations_cost.cost, plan.operations_cost)
-        self.assertEqual(plan.operations_cost, Decimal('150.0000'))
+        self.assertEqual(plan.operations_cost, Decimal('175.0000'))
         self.assertEqual(plan.cost_price,
                          plan.products_cost + plan.operations_cost)
 
@@ -195,6 +195,30 @@ class Test(unittest.TestCase):
         plan.click('compute')
         self.assertEqual(len(plan.operations), 2)
         self.assertEqual(len(plan.products), 2)
-        self.assertEqual(plan.operations_cost, Decimal('150.0000'))
+        self.assertEqual(plan.operations_cost, Decimal('175.0000'))
         self.assertEqual(plan.cost_price,
                          plan.products_cost + plan.operations_cost)
+
+        # Roll up the operations cost of the component plans
+        component_plan = CostPlan()
+        component_plan.product = component1
+        component_plan.route = route
+        component_plan.quantity = 1
+        component_plan.click('compute')
+        self.assertEqual(component_plan.operations_cost, Decimal('175.0000'))
+        self.assertEqual(component_plan.rollup_operations_cost,
+                         Decimal('175.0000'))
+        plan.reload()
+        self.assertEqual(plan.rollup_operations_cost, Decimal('1050.0000'))
+
+        # Detect the plans drifted from their route
+        self.assertEqual(plan.drifted, False)
+        self.assertEqual(plan.operations_cost_drift, Decimal('0.0000'))
+        route_operation, = [o for o in route.operations if o.sequence == 1]
+        route_operation.time = 6
+        route.save()
+        plan.reload()
+        self.assertEqual(plan.drifted, True)
+        self.assertEqual(plan.route_operations_cost, Decimal('200.0000'))
+        self.assertEqual(plan.operations_cost_drift, Decimal('25.0000'))
+        self.assertEqual(len(CostPlan.find([('drifted', '=', True)])), 3)
@@ -0,0 +1,131 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.cache import Cache
+from trytond.pool import Pool, PoolMeta
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
+
+__all__ = ['Uom', 'compute_qty', 'convert_qty', 'get_conversion',
+    'get_digits']
+
+_conversion_cache = Cache(
+    'product_cost_plan_operation.uom_conversion', context=False)
+_digits_cache = Cache('product_cost_plan_operation.uom_digits', context=False)
+_MISSING = object()
+
+
+def _conversion(from_uom, to_uom):
+    '''
+    Return the factors used by product.uom compute_qty to convert from_uom
+    into to_uom as a tuple (multiply, divide, divide, multiply) where only one
+    of each pair is set.
+    '''
+    if from_uom == to_uom:
+        return None
+    if from_uom.category.id != to_uom.category.id:
+        raise ValueError(
+            "cannot convert between %s and %s without a factor or rate"
+            % (from_uom.category.name, to_uom.category.name))
+    if from_uom.accurate_field == 'factor':
+        from_ = (from_uom.factor, None)
+    else:
+        from_ = (None, from_uom.rate)
+    if to_uom.accurate_field == 'factor':
+        to = (to_uom.factor, None)
+    else:
+        to = (None, to_uom.rate)
+    return from_ + to
+
+
+def get_conversion(from_uom, to_uom):
+    '''
+    Return the conversion from from_uom into to_uom from the cache keyed by
+    the pair of ids
+    '''
+    key = (from_uom.id, to_uom.id)
+    conversion = _conversion_cache.get(key, _MISSING)
+    if conversion is _MISSING:
+        conversion = _conversion_cache.set(key, _conversion(from_uom, to_uom))
+    return conversion
+
+
+def convert_qty(conversion, qty):
+    'Apply a conversion returned by get_conversion like compute_qty does'
+    if not qty or conversion is None:
+        return qty
+    from_factor, from_rate, to_factor, to_rate = conversion
+    if from_factor is not None:
+        amount = qty * from_factor
+    else:
+        amount = qty / from_rate
+    if to_factor is not None:
+        amount = amount / to_factor
+    else:
+        amount = amount * to_rate
+    return amount
+
+
+def compute_qty(from_uom, qty, to_uom):
+    'Same as product.uom compute_qty without rounding using cached factors'
+    if not qty or (from_uom is None and to_uom is None):
+        return qty
+    if from_uom is None:
+        raise ValueError("missing from_UoM")
+    if to_uom is None:
+        raise ValueError("missing to_UoM")
+    return convert_qty(get_conversion(from_uom, to_uom), qty)
+
+
+def get_digits(uom):
+    'Return the digits of uom from the cache keyed by its id'
+    digits = _digits_cache.get(uom.id)
+    if digits is None:
+        digits = _digits_cache.set(uom.id, uom.digits)
+    return digits
+
+
+class Uom(metaclass=PoolMeta):
+    __name__ = 'product.uom'
+
+    @classmethod
+    def on_modification(cls, mode, uoms, field_names=None):
+        super().on_modification(mode, uoms, field_names=field_names)
+        if mode == 'write' and field_names & {'rate', 'factor', 'category'}:
+            _conversion_cache.clear()
+            cls._refresh_operation_lines(uoms)
+        if mode == 'write' and 'digits' in field_names:
+            _digits_cache.clear()
+
+    @classmethod
+    def _refresh_operation_lines(cls, uoms):
+        '''
+        Flag the stored costs of the cost plan operation lines converted from
+        or into uoms as outdated and queue their refresh
+        '''
+        pool = Pool()
+        OperationLine = pool.get('product.cost.plan.operation_line')
+        Plan = pool.get('product.cost.plan')
+        Category = pool.get('production.work_center.category')
+        WorkCenter = pool.get('production.work_center')
+        line = OperationLine.__table__()
+        plan = Plan.__table__()
+        category = Category.__table__()
+        work_center = WorkCenter.__table__()
+        cursor = Transaction().connection.cursor()
+
+        line_ids = []
+        for sub_ids in grouped_slice([u.id for u in uoms]):
+            cursor.execute(*line.join(plan,
+                    condition=line.plan == plan.id
+                    ).join(category, 'LEFT',
+                    condition=line.work_center_category == category.id
+                    ).join(work_center, 'LEFT',
+                    condition=line.work_center == work_center.id
+                    ).select(line.id,
+                    where=reduce_ids(line.time_uom, sub_ids)
+                    | reduce_ids(line.quantity_uom, sub_ids)
+                    | reduce_ids(plan.uom, sub_ids)
+                    | reduce_ids(category.uom, sub_ids)
+                    | reduce_ids(work_center.uom, sub_ids)))
+            line_ids.extend(i for i, in cursor)
+        OperationLine.outdate_cost_rates(line_ids)
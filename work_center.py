@@ -0,0 +1,202 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from collections import defaultdict
+from decimal import Decimal
+
+from sql.aggregate import Max
+
+from trytond.cache import Cache
+from trytond.model import Index, ModelSQL, ModelView, Unique, fields
+from trytond.pool import Pool, PoolMeta
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
+
+from .plan import DIGITS
+
+__all__ = ['WorkCenterCategory', 'WorkCenterCategoryRate', 'WorkCenter']
+
+
+def _refresh_operation_lines(field_name, records):
+    '''
+    Flag the stored costs of the cost plan operation lines whose field_name is
+    one of records as outdated and queue their refresh
+    '''
+    pool = Pool()
+    OperationLine = pool.get('product.cost.plan.operation_line')
+    line = OperationLine.__table__()
+    cursor = Transaction().connection.cursor()
+
+    line_ids = []
+    for sub_ids in grouped_slice([r.id for r in records]):
+        cursor.execute(*line.select(line.id,
+                where=reduce_ids(getattr(line, field_name), sub_ids)))
+        line_ids.extend(i for i, in cursor)
+    # The getters compute the outdated costs until the queued refresh stores
+    # them again
+    OperationLine.outdate_cost_rates(line_ids)
+
+
+class WorkCenterCategory(metaclass=PoolMeta):
+    __name__ = 'production.work_center.category'
+    rates = fields.One2Many('production.work_center.category.rate',
+        'category', 'Rates',
+        help="The cost prices effective from a date used to price cost plans "
+        "as of a date.\n"
+        "The cost price is updated to the rate effective today.")
+
+    @classmethod
+    def on_modification(cls, mode, categories, field_names=None):
+        super().on_modification(mode, categories, field_names=field_names)
+        if mode == 'write' and field_names & {'cost_price', 'uom'}:
+            _refresh_operation_lines('work_center_category', categories)
+
+    @classmethod
+    def update_cost_prices(cls, categories=None):
+        '''
+        Set the cost price of the categories, all those having rates by
+        default, to their rate effective today so the cost price is always
+        the current rate.
+        The categories without a rate effective today keep their cost price.
+        '''
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Rate = pool.get('production.work_center.category.rate')
+        today = Date.today()
+        if categories is None:
+            categories = cls.search([
+                    ('rates.effective_date', '<=', today),
+                    ])
+        cost_prices = Rate.get_cost_prices([c.id for c in categories], today)
+
+        to_write = defaultdict(list)
+        for category in categories:
+            cost_price = cost_prices.get(category.id)
+            if cost_price is not None and cost_price != category.cost_price:
+                to_write[cost_price].append(category)
+        if to_write:
+            args = []
+            for cost_price, sub_categories in to_write.items():
+                args.extend((sub_categories, {'cost_price': cost_price}))
+            cls.write(*args)
+
+
+class WorkCenterCategoryRate(ModelSQL, ModelView):
+    'Work Center Category Rate'
+    __name__ = 'production.work_center.category.rate'
+    category = fields.Many2One('production.work_center.category',
+        'Category', required=True, ondelete='CASCADE')
+    effective_date = fields.Date('Effective Date', required=True,
+        help="The date from which the cost price applies.")
+    cost_price = fields.Numeric('Cost Price', digits=DIGITS, required=True)
+    _cost_prices_cache = Cache(
+        'production.work_center.category.rate.cost_prices', context=False)
+
+    @classmethod
+    def __setup__(cls):
+        super(WorkCenterCategoryRate, cls).__setup__()
+        cls._order.insert(0, ('effective_date', 'DESC'))
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('category_effective_date_uniq',
+                Unique(t, t.category, t.effective_date),
+                'product_cost_plan_operation.rate_effective_date_unique'),
+            ]
+        cls._sql_indexes.add(
+            Index(t,
+                (t.category, Index.Range()),
+                (t.effective_date, Index.Range())))
+
+    @classmethod
+    def on_modification(cls, mode, rates, field_names=None):
+        pool = Pool()
+        Category = pool.get('production.work_center.category')
+        super().on_modification(mode, rates, field_names=field_names)
+        cls._cost_prices_cache.clear()
+        if mode in {'create', 'write'}:
+            Category.update_cost_prices(list({r.category for r in rates}))
+
+    @classmethod
+    def on_write(cls, rates, values):
+        pool = Pool()
+        Category = pool.get('production.work_center.category')
+        callback = super().on_write(rates, values)
+        if 'category' in values:
+            categories = list({r.category for r in rates})
+            callback.append(lambda: Category.update_cost_prices(categories))
+        return callback
+
+    @classmethod
+    def on_delete(cls, rates):
+        pool = Pool()
+        Category = pool.get('production.work_center.category')
+        callback = super().on_delete(rates)
+        categories = list({r.category for r in rates})
+        if categories:
+            callback.append(cls._cost_prices_cache.clear)
+            callback.append(lambda: Category.update_cost_prices(categories))
+        return callback
+
+    @classmethod
+    def get_cost_price(cls, category_id, date):
+        '''
+        Return the cost price effective at date of the category or None.
+        The rates of all the categories at date are read once and cached.
+        '''
+        key = date.isoformat()
+        cost_prices = cls._cost_prices_cache.get(key)
+        if cost_prices is None:
+            table = cls.__table__()
+            cursor = Transaction().connection.cursor()
+            cursor.execute(*table.select(table.category,
+                    group_by=table.category))
+            cost_prices = cls._cost_prices_cache.set(key, list(
+                    cls.get_cost_prices([c for c, in cursor], date).items()))
+        return dict(cost_prices).get(category_id)
+
+    @classmethod
+    def get_cost_prices_query(cls, date, category_ids=None):
+        '''
+        Return the query of the category and the cost price of the rates
+        effective at date, restricted to category_ids if set
+        '''
+        table = cls.__table__()
+        latest = cls.__table__()
+        where = latest.effective_date <= date
+        if category_ids is not None:
+            where &= reduce_ids(latest.category, category_ids)
+        query = latest.select(
+            latest.category,
+            Max(latest.effective_date).as_('effective_date'),
+            where=where,
+            group_by=latest.category)
+        return table.join(query,
+            condition=(table.category == query.category)
+            & (table.effective_date == query.effective_date)
+            ).select(table.category, table.cost_price)
+
+    @classmethod
+    def get_cost_prices(cls, category_ids, date):
+        '''
+        Return the cost price effective at date by category id for the
+        categories having a rate at that date
+        '''
+        cursor = Transaction().connection.cursor()
+
+        cost_prices = {}
+        for sub_ids in grouped_slice(category_ids):
+            cursor.execute(*cls.get_cost_prices_query(date, list(sub_ids)))
+            for category_id, cost_price in cursor:
+                if not isinstance(cost_price, Decimal):
+                    cost_price = Decimal(str(cost_price))
+                cost_prices[category_id] = cost_price
+        return cost_prices
+
+
+class WorkCenter(metaclass=PoolMeta):
+    __name__ = 'production.work_center'
+
+    @classmethod
+    def on_modification(cls, mode, work_centers, field_names=None):
+        super().on_modification(mode, work_centers, field_names=field_names)
+        if mode == 'write' and field_names & {'cost_price', 'uom'}:
+            _refresh_operation_lines('work_center', work_centers)